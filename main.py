@@ -7,6 +7,7 @@ from modules.base_agent import BaseAgent
 from battles import Battle, start_loop
 from modules.fp_gacha import FpGacha
 from modules.lottery import Lottery
+from modules.template_compiler import TemplateCompiler
 from util.autogui import config, screenshot, is_interactive_mode  # noqas, for interactive interpreter
 from util.base import catch_exception, ArgParser
 
@@ -27,6 +28,8 @@ def start(action=None, cfg=None):
         task = FpGacha()
     elif parser.action == 'server':
         task = BaseAgent()
+    elif parser.action == 'compile':
+        task = TemplateCompiler()
     else:
         raise KeyError(f'invalid key: action={parser.action}')
     globals()['task'] = task
@@ -8,6 +8,8 @@ from . import fp_gacha
 from . import lottery
 from . import master
 from . import server
+from . import support_scanner
+from . import template_compiler
 
 __all__ = [
     'battle_base',
@@ -15,5 +17,7 @@ __all__ = [
     'fp_gacha',
     'lottery',
     'master',
-    'server'
+    'server',
+    'support_scanner',
+    'template_compiler'
 ]
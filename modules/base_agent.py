@@ -18,17 +18,34 @@ class BaseAgent:
 
     def pre_process(self, cfg):
         config.load(cfg)
+        ImageTemplates.load_bundle(config.template_bundle)
         self.LOC.reset(config.is_jp)
         config.initialize()
         if config.www_host_port is not None:
             self.run_sever(*config.www_host_port)
 
+    def locate(self, box):
+        """
+        Relocate regions into box of screen.
+
+        :param box: (x0,y0,x1,y1), None for default (0,0,1920,1080),
+                    or "auto" to detect it from screenshot, and re-detect it if task gets stuck(see supervisor).
+        """
+        if box == 'auto':
+            config.temp['auto_locate'] = True
+            auto_relocate(self.LOC)
+        else:
+            config.temp.pop('auto_locate', None)
+            self.LOC.relocate(box)
+
     def start(self, timeout=None, cfg=None):
         """overrider and implement detail procedures"""
         self.pre_process(cfg)
 
     # noinspection PyMethodMayBeStatic
     def post_process(self):
+        # counters may be saved lazily during task, see `config.save_counters`
+        config.save()
         # server thread should be daemon, make it possible to be terminated by Ctrl-C
         # in terminal: keep app running until ctrl-C pressed => call thread.join() in post processing
         # in interactive: main thread is always alive, join() is not needed, we can terminate it manually.
@@ -1,6 +1,7 @@
 from util.goto import *
 from util.supervisor import *
 from .base_agent import *
+from .drops_stat import DropsRecorder, get_battle_store
 from .master import *
 
 
@@ -8,6 +9,7 @@ class BattleBase(BaseAgent):
     def __init__(self):
         logger.set_cur_logger('log')
         self.master = Master()
+        self.drops_recorder: Optional[DropsRecorder] = None
         super().__init__()
 
     @property
@@ -41,11 +43,13 @@ class BattleBase(BaseAgent):
         # pre-processing
         self.pre_process(cfg)
         config.mail = config.battle.mail
-        self.LOC.relocate(config.battle.location)
+        self.locate(config.battle.location)
         battle_func = getattr(self, config.battle.battle_func)
         battle_func(True)
         config.T = self.T
         config.LOC = self.LOC
+        if config.drop_items_dir is not None and get_battle_store() is not None:
+            self.drops_recorder = DropsRecorder(config.drop_items_dir, get_battle_store(), self.LOC)
         if config.battle.sell_times > 0 and self.T.bag_full_alert is None:
             logger.warning('set bag_full_alert template if sell_times is set!!!')
             return
@@ -81,42 +85,44 @@ class BattleBase(BaseAgent):
             logger.info(f'========= Battle "{self.master.quest_name}" No.{finished_num}/{battle_num} =========',
                         extra=LOG_TIME)
             if not config.battle.jump_battle:
+                poller = FramePoller(max_interval=0.5)
                 while True:
-                    shot = screenshot()
-                    res = search_target(shot.crop(LOC.quest_outer), T.quest.crop(LOC.quest))
+                    shot = poller.next()
+                    res = search_target(crop(shot, LOC.quest_outer), T.quest, target_region=LOC.quest)
                     if res[0] > THR:
                         # match quest entrance
                         _x = LOC.quest_outer[0] + res[1][0] + (LOC.quest[2] - LOC.quest[0]) / 2
                         _y = LOC.quest_outer[1] + res[1][1] + (LOC.quest[3] - LOC.quest[1]) / 2
                         click((_x, _y))
-                    elif match_targets(shot, T.apple_page, LOC.apple_close):
+                        continue
+                    page = classify_page(shot, ['apple_page', 'bag_full_alert', 'restart_quest', 'apply_friend',
+                                                'quest_menu', 'support'], T, LOC).name
+                    if page == 'apple_page':
                         if finished_num > battle_num and config.battle.end_until_eating_apple:
                             config.mark_task_finish(f'Finished: all {finished_num}/{battle_num} '
                                                     f'battles finished and AP cleared')
                         else:
                             self.master.eat_apple(apples)
-                    elif T.bag_full_alert is not None \
-                            and match_targets(shot, T.bag_full_alert, LOC.bag_full_sell_button):
+                    elif page == 'bag_full_alert':
                         # usually used in hunting events.
                         logger.info('bag full, to sell...')
                         click(LOC.bag_full_sell_button)
                         self.sell(config.battle.sell_times, 1, 1)
                         wait_targets(T.shop, LOC.menu_button, at=LOC.bag_back)
-                        wait_search_template(T.quest.crop(LOC.quest), LOC.quest_outer)
+                        wait_search_template(T.quest, LOC.quest_outer, target_region=LOC.quest)
                         logger.debug('back from shop to quest', extra=LOG_TIME)
-                    elif match_targets(shot, T.restart_quest, LOC.restart_quest_yes):
+                    elif page == 'restart_quest':
                         click(LOC.restart_quest_yes)
                         logger.debug('restart the same battle')
-                    elif match_targets(shot, T.apply_friend, LOC.apply_friend):
+                    elif page == 'apply_friend':
                         click(LOC.apply_friend_deny)
                         logger.debug('not to apply friend')
-                    elif match_targets(shot, T.quest, LOC.menu_button):
+                    elif page == 'quest_menu':
                         # maybe re-login when daily refresh
                         if callable(config.battle.login_handler):
                             config.battle.login_handler()
-                    elif match_targets(shot, T.support, LOC.support_refresh):
+                    elif page == 'support':
                         break
-                    sleep(0.5)
 
             battle_func()
 
@@ -135,17 +141,16 @@ class BattleBase(BaseAgent):
 
             click(LOC.rewards_show_num, lapse=1)
             # check reward_page has CE dropped or not
-            rewards = screenshot()
+            rewards = screenshot(as_array=True)
             drop_dir = f'img/_drops/{self.master.quest_name}'
-            if not os.path.exists(drop_dir):
-                os.makedirs(drop_dir)
             # png_fn without suffix
             png_fn = os.path.join(drop_dir, f'rewards-{self.master.quest_name}-{time.strftime("%m%d-%H%M")}'
                                             f'-{config.battle.finished}')
             if config.battle.check_drop > 0 and self.master.check_rewards(rewards, config.battle.check_drop):
                 config.record_craft_drop()
                 logger.warning(f'{config.battle.craft_num}th craft dropped!!!')
-                rewards.save(f'{png_fn}-drop{config.battle.craft_num}.png')
+                rewards_fp = self.save_rewards(rewards, f'{png_fn}-drop{config.battle.craft_num}')
+                self.record_battle(dt, rewards, rewards_fp, config.battle.craft_num)
                 if config.battle.craft_num in config.battle.enhance_craft_nums:
                     logger.warning('need to change party or enhance crafts. Exit.')
                     send_mail(f'Enhance! {config.battle.craft_num}th craft dropped!!!')
@@ -161,26 +166,52 @@ class BattleBase(BaseAgent):
                 click(LOC.rewards_next)
             else:
                 click(LOC.rewards_next)
-                rewards.save(f"{png_fn}.png")
+                rewards_fp = self.save_rewards(rewards, png_fn) if config.rewards_save else None
+                self.record_battle(dt, rewards, rewards_fp)
 
             # ready to restart a battle
             if finished_num % 25 == 0:
                 send_mail(f'Progress: {finished_num}/{battle_num} battles.',
                           attach_shot=False, level=MailLevel.info)
+            poller = FramePoller(max_interval=0.5)
             while True:
-                shot = screenshot()
-                if search_target(shot.crop(LOC.quest_outer), T.quest.crop(LOC.quest))[0] > THR:
+                shot = poller.next()
+                if search_target(crop(shot, LOC.quest_outer), T.quest, target_region=LOC.quest)[0] > THR:
                     break
                 elif match_targets(shot, T.restart_quest, LOC.restart_quest_yes):
                     break
                 elif match_targets(shot, T.apply_friend, LOC.apply_friend):
                     click(LOC.apply_friend_deny)
                     logger.debug('not to apply friend')
-                sleep(0.5)
         logger.info(f'>>>>> All {finished_num}/{battle_num} battles "{self.master.quest_name}" finished. <<<<<')
         config.mark_task_finish(f'Finished: all {finished_num}/{battle_num} battles of "{self.master.quest_name}"')
         return
 
+    def save_rewards(self, rewards: ImageLike, fn: str) -> str:
+        """
+        Save rewards screenshot in background(see `ImageWriter`), format and cropping are decided by config.
+
+        :param rewards: screenshot of rewards page.
+        :param fn: filepath without suffix.
+        :return: filepath with suffix.
+        """
+        params = ImageWriter.save_params(config.rewards_format, config.rewards_compress_level)
+        region = self.LOC.rewards_grid if config.rewards_crop else None
+        fp = f'{fn}.{config.rewards_format.lower()}'
+        get_image_writer().put(rewards, fp, region, **params)
+        return fp
+
+    def record_battle(self, duration: float, rewards: ImageLike, rewards_fp: str = None, craft_drop: int = None):
+        """record finished battle into `BattleStore` if enabled, and recognize its drops in background"""
+        store = get_battle_store()
+        if store is None:
+            return
+        battle_id = store.add_battle(self.master.quest_name, duration, self.master.eaten_apple, craft_drop,
+                                     rewards_fp, config.id)
+        self.master.eaten_apple = None
+        if self.drops_recorder is not None:
+            self.drops_recorder.submit(battle_id, rewards)
+
     # noinspection DuplicatedCode
     @with_goto
     def battle_template(self, pre_process=False):
@@ -280,7 +311,7 @@ class BattleBase(BaseAgent):
         """
 
         T, LOC = self.T, self.LOC
-        if match_which_target(screenshot(), [T.login_news, T.login_popup], [LOC.login_news_close, LOC.menu_button]) < 0:
+        if classify_page(None, ['login_news', 'login_popup'], T, LOC).name is None:
             return False
 
         logger.warning('Handle login or popups')
@@ -288,23 +319,23 @@ class BattleBase(BaseAgent):
         time_limit = 120
         t0 = time.time()
 
-        if quest_regions is None:
-            quest_regions = [LOC.quest]
+        quest_page = 'quest' if quest_regions is None else Page('quest', 'quest', quest_regions)
         while True:
-            shot = screenshot()
-            if match_targets(shot, T.login_news, LOC.login_news_close):
+            page = classify_page(None, ['login_news', 'login_terminal', quest_page, 'login_popup', 'support'],
+                                 T, LOC).name
+            if page == 'login_news':
                 click(LOC.login_news_close)
                 logger.debug('close login news page')
-            elif match_targets(shot, T.login_terminal, LOC.login_terminal_event_banner):
+            elif page == 'login_terminal':
                 click(LOC.login_terminal_event_banner)
                 logger.debug('enter event banner')
                 time.sleep(3)
-            elif match_targets(shot, T.quest, quest_regions):
+            elif page == 'quest':
                 click(LOC.quest_c)
                 logger.debug('enter quest')
-            elif match_targets(shot, T.login_popup, LOC.menu_button):
+            elif page == 'login_popup':
                 click(LOC.login_popup_clicking)
-            elif match_targets(shot, T.support, LOC.support_refresh):
+            elif page == 'support':
                 logger.debug('back to support page!')
                 return True
             time.sleep(3)
@@ -1,7 +1,20 @@
+import atexit
+import contextlib
+import hashlib
+import itertools
+import json
+import math
 import re
+import sqlite3
+import tempfile
+import uuid
+from concurrent.futures import wait, FIRST_COMPLETED, Future, ProcessPoolExecutor
+from typing import Iterator
 
 from util.autogui import *
 
+_REWARDS_PATTERN = re.compile(r'rewards-(.*?)-([\d\-]+)\.(?:png|webp)$')
+
 
 # O=(233,187,409,379)
 # dx=206
@@ -9,62 +22,514 @@ from util.autogui import *
 # w=176
 # h=192
 class DropsStat:
-    def __init__(self):
-        self.images: Dict[str, Image.Image] = {}
-        self.LOC = Regions()
-        self.item_templates: Dict[str, Image.Image] = {}
+    """
+    Count drops of rewards screenshots archive.
+
+    Screenshots are streamed from directories rather than loaded at once, and results of every file are kept in
+    a persisted index(see `calc`), so re-running only processes new or modified screenshots.
+    """
+
+    def __init__(self, hash_prefilter: Optional[int] = None, LOC: Regions = None):
+        """
+        :param hash_prefilter: max hamming distance of image hash between item and template, only templates within it
+                               are searched. None to search all templates. It may change counts if it's too small,
+                               validate it with `calibrate_hash_prefilter` before enabling.
+        :param LOC: regions of rewards page, default `Regions()`
+        """
+        self.directories: List[str] = []
+        self.LOC = LOC or Regions()
+        self.item_templates: Dict[str, ImageLike] = {}
         self.stat_results: Dict[str, int] = {}
-        self._no, self._num = 0, len(self.images)
-        pass
+        # {filepath: {'mtime': st_mtime_ns, 'size': st_size, 'items': {item_name: num}}}
+        self.index: Dict[str, Dict[str, Any]] = {}
+        self._no, self._num = 0, 0
+        self.hash_prefilter = hash_prefilter
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
 
     def load_item_template(self, directory: str, *item_locs):
         """
-        :param directory:
-        :param item_locs: [item_name, img_fn, row, column]
+        :param directory: folder of rewards screenshots, it's added to the directories to count.
+        :param item_locs: [item_name, img_fn, row, column], only these screenshots are opened.
         :return:
         """
-        for filename in os.listdir(directory):
-            matched = re.findall(r'rewards-(.*?)-([\d\-]+).png', filename)
-            if matched:
-                self.images[filename] = Image.open(os.path.join(directory, filename))
+        if directory not in self.directories:
+            self.directories.append(directory)
         for item_name, img_fn, row, column in item_locs:
-            assert img_fn in self.images and 0 <= row <= 2 and 0 <= column <= 6
-            self.item_templates[item_name] = self.images[img_fn].crop(self.LOC.rewards_items[row][column])
+            assert _REWARDS_PATTERN.match(img_fn) and 0 <= row <= 2 and 0 <= column <= 6
+            with Image.open(os.path.join(directory, img_fn)) as img:
+                self.item_templates[item_name] = self._full_size(img).crop(self.LOC.rewards_items[row][column])
 
-    def calc(self):
-        self.stat_results.clear()
+    def load_item_dir(self, directory: str):
+        """load item templates saved by `save_item_templates`, filename is the item name"""
+        for filename in os.listdir(directory):
+            if filename.endswith('.png'):
+                image = Image.open(os.path.join(directory, filename))
+                self.item_templates[filename[:-4]] = image.convert('RGB')
+
+    def save_item_templates(self, directory: str):
+        """save item templates as "{item_name}.png" in directory, which could be used by `DropsRecorder`"""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for item_name, template in self.item_templates.items():
+            template.save(os.path.join(directory, f'{item_name}.png'))
+
+    def _full_size(self, img: Image.Image) -> Image.Image:
+        """paste rewards grid(saved with `config.rewards_crop`) back to its place of full screenshot"""
+        grid = self.LOC.rewards_grid
+        if img.size != (grid[2] - grid[0], grid[3] - grid[1]):
+            return img
+        full = Image.new('RGB', (self.LOC.width, self.LOC.height))
+        full.paste(img.convert('RGB'), grid[:2])
+        return full
 
-        from concurrent.futures import ThreadPoolExecutor
-        executor = ThreadPoolExecutor(max_workers=20)
-        for _ in executor.map(self._cal_one, list(self.images.keys())):
-            # print(res)
-            pass
-        print(f'All {self._num} finished.')
+    def iter_files(self) -> Iterator[str]:
+        """filepaths of rewards screenshots in directories, listed lazily"""
+        for directory in self.directories:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and _REWARDS_PATTERN.match(entry.name):
+                        yield entry.path
+
+    def signature(self) -> str:
+        """digest of item templates and options, results in index are invalid if it changes"""
+        md5 = hashlib.md5(json.dumps([self.hash_prefilter, self.LOC.rewards_items_outer]).encode())
+        for item_name in sorted(self.item_templates):
+            md5.update(item_name.encode('utf8'))
+            md5.update(numpy.asarray(self.item_templates[item_name].convert('RGB')).tobytes())
+        return md5.hexdigest()
+
+    def load_index(self, fp: str):
+        """load processed files from index, which is discarded if item templates changed"""
+        self.index = {}
+        if fp is None or not os.path.exists(fp):
+            return
+        try:
+            with open(fp, 'r', encoding='utf8') as fd:
+                data = json.load(fd)
+        except ValueError:
+            logger.warning(f'invalid drops index "{fp}", all screenshots will be processed.')
+            return
+        if data.get('signature') == self.signature():
+            self.index = data.get('files', {})
+
+    def save_index(self, fp: str):
+        """save index atomically, so an interrupted run could be resumed"""
+        if fp is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                content = json.dumps({'signature': self.signature(), 'files': self.index}, ensure_ascii=False)
+            tmp_fp = f'{fp}.{os.getpid()}.tmp'
+            with open(tmp_fp, 'w', encoding='utf8') as fd:
+                fd.write(content)
+            os.replace(tmp_fp, fp)
+
+    def calc(self, index_fp: str = '', workers=8, save_every=200, processes=0, chunk_size=16):
+        """
+        Count drops of all screenshots in directories.
+
+        Files are streamed, at most `2*workers` images(or `2*processes` batches) are opened at the same time,
+        so memory doesn't grow with the archive. Files already in index with the same mtime and size are skipped.
+
+        :param index_fp: persisted index of processed files, default "_drops_index.json" in the first directory.
+                         None to process all files without index.
+        :param workers: threads to recognize images, cv2 releases the GIL.
+        :param save_every: save index after every N processed files.
+        :param processes: if >0, recognize images in a process pool instead of threads, see `_calc_processes`.
+        :param chunk_size: files of every batch sent to process.
+        """
+        if index_fp == '':
+            index_fp = os.path.join(self.directories[0], '_drops_index.json') if self.directories else None
+        self.load_index(index_fp)
+        self._no, self._num = 0, 0
+        if processes > 0:
+            self._calc_processes(index_fp, save_every, processes, chunk_size)
+        else:
+            pending = set()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for filepath, stat in self._new_files():
+                    if len(pending) >= 2 * workers:
+                        _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    pending.add(executor.submit(self._cal_one, filepath, stat, index_fp, save_every))
+                wait(pending)
+        self.save_index(index_fp)
+        self.stat_results.clear()
+        for entry in self.index.values():
+            for item_name, num in entry['items'].items():
+                self.stat_results[item_name] = self.stat_results.get(item_name, 0) + num
+        print(f'All {self._num} new images finished.')
         self.print_results()
 
-    def _cal_one(self, fn):
-        img = self.images[fn]
-        for i in range(3):
-            for j in range(7):
-                if i == j == 0:
-                    continue
-                outer = img.crop(self.LOC.rewards_items_outer[i][j])
-                match_res = []
-                for item_name, tmpl in self.item_templates.items():
-                    match_res.append([item_name, search_target(outer, tmpl)[0]])
-                match_res.sort(key=lambda o: o[1], reverse=True)
-                match_item, match_prob = match_res[0]
-                if match_res[0][1] > 0.95:
-                    self.stat_results[match_item] = self.stat_results.get(match_item, 0) + 1
-        self._no += 1
-        print(f'\rprogress {self._no}/{self._num} ...\r', end='')
+    def _new_files(self) -> Iterator[Tuple[str, os.stat_result]]:
+        """files not in index or modified, counted in `_num`"""
+        for filepath in self.iter_files():
+            stat = os.stat(filepath)
+            entry = self.index.get(filepath)
+            if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                continue
+            self._num += 1
+            yield filepath, stat
+
+    def _calc_processes(self, index_fp: str, save_every: int, processes: int, chunk_size: int):
+        """
+        Recognize images in processes, which is not limited by the GIL of PIL decoding and python code.
+
+        Item templates are dumped once into a memory-mapped npy file shared by all workers rather than pickled
+        for every task. Files are sent in batches, and results are merged into index in this process.
+        """
+        with tempfile.TemporaryDirectory(prefix='drops-') as tmp_dir:
+            templates_fp = os.path.join(tmp_dir, 'templates.npy')
+            layout, arrays, offset = [], [], 0
+            for item_name, template in self.item_templates.items():
+                array = numpy.asarray(template.convert('RGB'))
+                layout.append((item_name, array.shape, offset))
+                arrays.append(array.ravel())
+                offset += array.size
+            numpy.save(templates_fp, numpy.concatenate(arrays) if arrays else numpy.zeros(0, numpy.uint8))
+            pending: Dict[Future, List[Tuple[str, os.stat_result]]] = {}
+
+            def _merge(_futures):
+                for future in _futures:
+                    for (_filepath, _stat), counts in zip(pending.pop(future), future.result()):
+                        if isinstance(counts, str):
+                            logger.error(f'failed to recognize "{_filepath}": {counts}')
+                        else:
+                            self._record(_filepath, _stat, counts, index_fp, save_every)
+
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_drops_worker,
+                                     initargs=(templates_fp, layout, self.hash_prefilter, self.LOC)) as executor:
+                files = self._new_files()
+                while True:
+                    batch = list(itertools.islice(files, chunk_size))
+                    if not batch:
+                        break
+                    if len(pending) >= 2 * processes:
+                        _merge(wait(pending, return_when=FIRST_COMPLETED)[0])
+                    pending[executor.submit(_recognize_files, [filepath for filepath, _ in batch])] = batch
+                _merge(wait(pending)[0])
+
+    def recognize(self, img: ImageLike, threshold=0.95) -> Dict[str, int]:
+        """
+        Recognize dropped items in rewards screenshot.
+
+        :param img: screenshot of rewards page, PIL image or RGB array.
+        :param threshold: min similarity of item template in the cell.
+        :return: {item_name: num}
+        """
+        counts: Dict[str, int] = {}
+        all_names, all_templates = list(self.item_templates.keys()), list(self.item_templates.values())
+        for i, j in self._cells():
+            names = all_names
+            if self.hash_prefilter is not None:
+                distances = hash_distances(crop(img, self.LOC.rewards_items[i][j]), all_templates)
+                names = [name for name, d in zip(all_names, distances) if d <= self.hash_prefilter]
+            match_item = self._match_cell(img, i, j, names, threshold)
+            if match_item is not None:
+                counts[match_item] = counts.get(match_item, 0) + 1
+        return counts
+
+    @staticmethod
+    def _cells() -> Iterator[Tuple[int, int]]:
+        """(row, column) of item cells, the first one is QP"""
+        return ((i, j) for i in range(3) for j in range(7) if not i == j == 0)
+
+    def _match_cell(self, img: ImageLike, i: int, j: int, names: List[str], threshold: float) -> Optional[str]:
+        """the best matched item among names in cell, None if not matched"""
+        if not names:
+            return None
+        outer = crop(img, self.LOC.rewards_items_outer[i][j])
+        match_res = []
+        for item_name in names:
+            match_res.append([item_name, search_target(outer, self.item_templates[item_name])[0]])
+        match_res.sort(key=lambda o: o[1], reverse=True)
+        match_item, match_prob = match_res[0]
+        return match_item if match_prob > threshold else None
+
+    def calibrate_hash_prefilter(self, max_files=200, margin=4, threshold=0.95) -> Optional[int]:
+        """
+        Find a safe `hash_prefilter` from screenshots in directories.
+
+        Cells are recognized without prefilter, the max hash distance between a recognized cell and its item template
+        plus `margin` is returned, which keeps counts of these screenshots unchanged. Set it to `hash_prefilter` to
+        enable the prefilter.
+
+        :param max_files: at most N screenshots are checked.
+        :return: threshold, None if no item is recognized.
+        """
+        all_names = list(self.item_templates.keys())
+        max_distance = None
+        for filepath in itertools.islice(self.iter_files(), max_files):
+            with Image.open(filepath) as img:
+                img = self._full_size(img)
+                for i, j in self._cells():
+                    match_item = self._match_cell(img, i, j, all_names, threshold)
+                    if match_item is None:
+                        continue
+                    distance = int(hash_distances(crop(img, self.LOC.rewards_items[i][j]),
+                                                  [self.item_templates[match_item]])[0])
+                    max_distance = distance if max_distance is None else max(max_distance, distance)
+        return None if max_distance is None else max_distance + margin
+
+    def _cal_one(self, filepath: str, stat: os.stat_result, index_fp: str = None, save_every=200):
+        try:
+            with Image.open(filepath) as img:
+                counts = self.recognize(self._full_size(img))
+        except Exception as e:  # noqa
+            logger.error(f'failed to recognize "{filepath}": {e}')
+            return
+        self._record(filepath, stat, counts, index_fp, save_every)
+
+    def _record(self, filepath: str, stat: os.stat_result, counts: Dict[str, int], index_fp: str, save_every: int):
+        with self._lock:
+            self.index[filepath] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'items': counts}
+            self._no += 1
+            no = self._no
+        if no % save_every == 0:
+            self.save_index(index_fp)
+        print(f'\rprogress {no}/{self._num} ...\r', end='')
 
     def print_results(self):
         print(f'===== Results =====')
-        print(f'image num: {self._num}')
+        print(f'image num: {len(self.index)}')
         print(f'items num: {self.stat_results}')
 
 
+# DropsStat of worker process, see `DropsStat._calc_processes`
+_worker_stat: Optional[DropsStat] = None
+
+
+def _init_drops_worker(templates_fp: str, layout: List[Tuple[str, Tuple[int, ...], int]], hash_prefilter, LOC):
+    global _worker_stat
+    data = numpy.load(templates_fp, mmap_mode='r')
+    _worker_stat = DropsStat(hash_prefilter, LOC)
+    for item_name, shape, offset in layout:
+        _worker_stat.item_templates[item_name] = data[offset:offset + int(numpy.prod(shape))].reshape(shape)
+
+
+def _recognize_files(filepaths: List[str]) -> List[Union[Dict[str, int], str]]:
+    """:return: counts of every file, or error message if failed"""
+    results = []
+    for filepath in filepaths:
+        try:
+            with Image.open(filepath) as img:
+                results.append(_worker_stat.recognize(_worker_stat._full_size(img)))  # noqa
+        except Exception as e:  # noqa
+            results.append(f'{e.__class__.__name__}: {e}')
+    return results
+
+
+def wilson_interval(k: int, n: int, z=1.96) -> Tuple[float, float]:
+    """Wilson score interval of binomial proportion k/n, z=1.96 for 95% confidence"""
+    if n <= 0:
+        return 0.0, 1.0
+    p = k / n
+    denominator = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denominator
+    half = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+class BattleStore:
+    """
+    SQLite database of battles: one row per battle(quest, time, duration, apple, screenshot...) and its drops.
+
+    Rows are buffered and written in one transaction per batch(every `batch_size` rows or `flush_interval` secs,
+    before queries and at exit), rather than one disk write per battle. Battles are indexed by quest and time.
+    Battle id is a uuid generated at adding, so that drops recognized later could refer to it before it's written,
+    and several accounts could share one database.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS battles (
+            id TEXT PRIMARY KEY,
+            account TEXT,
+            quest TEXT NOT NULL,
+            time REAL NOT NULL,
+            duration REAL,
+            apple INTEGER,
+            craft_drop INTEGER,
+            screenshot TEXT,
+            recognized INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS battles_quest_time ON battles (quest, time);
+        CREATE INDEX IF NOT EXISTS battles_time ON battles (time);
+        CREATE TABLE IF NOT EXISTS drops (
+            battle_id TEXT NOT NULL REFERENCES battles (id),
+            item TEXT NOT NULL,
+            num INTEGER NOT NULL,
+            PRIMARY KEY (battle_id, item)
+        );
+    """
+
+    def __init__(self, fp: str, batch_size=20, flush_interval=60.0):
+        self.fp = fp
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        folder = os.path.dirname(fp)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with contextlib.closing(self._connect()) as conn:
+            conn.executescript(self.SCHEMA)
+        self._battles: List[tuple] = []
+        self._drops: List[tuple] = []
+        self._recognized: List[tuple] = []
+        self._flushed_time = time.time()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _connect(self) -> sqlite3.Connection:
+        # connection per batch, store is used by battle, drops worker and server threads
+        return sqlite3.connect(self.fp, timeout=30)
+
+    def add_battle(self, quest: str, duration: float = None, apple: int = None, craft_drop: int = None,
+                   screenshot: str = None, account: str = None) -> str:
+        """
+        :param apple: apple eaten before this battle, see `Master.eat_apple`.
+        :param craft_drop: No. of dropped craft if dropped.
+        :param screenshot: filepath of saved rewards screenshot.
+        :return: battle id
+        """
+        battle_id = uuid.uuid4().hex
+        with self._lock:
+            self._battles.append((battle_id, account, quest, time.time(), duration, apple, craft_drop, screenshot))
+        self._flush_if_needed()
+        return battle_id
+
+    def add_drops(self, battle_id: str, items: Dict[str, int]):
+        """record recognized drops of battle, battles without drops recognized are excluded from drop rates"""
+        with self._lock:
+            self._drops.extend((battle_id, item_name, num) for item_name, num in items.items())
+            self._recognized.append((battle_id,))
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if len(self._battles) + len(self._recognized) >= self.batch_size \
+                or time.time() - self._flushed_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """write buffered rows in one transaction"""
+        with self._write_lock:
+            with self._lock:
+                battles, drops, recognized = self._battles, self._drops, self._recognized
+                self._battles, self._drops, self._recognized = [], [], []
+                self._flushed_time = time.time()
+            if not (battles or drops or recognized):
+                return
+            with contextlib.closing(self._connect()) as conn, conn:
+                conn.executemany('INSERT INTO battles (id, account, quest, time, duration, apple, '
+                                 'craft_drop, screenshot) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', battles)
+                conn.executemany('INSERT OR REPLACE INTO drops (battle_id, item, num) VALUES (?, ?, ?)', drops)
+                conn.executemany('UPDATE battles SET recognized = 1 WHERE id = ?', recognized)
+
+    @staticmethod
+    def _where(quest: str = None, since: float = None, until: float = None, alias='') -> Tuple[str, list]:
+        conditions, params = [], []
+        for column, op, value in (('quest', '=', quest), ('time', '>=', since), ('time', '<', until)):
+            if value is not None:
+                conditions.append(f'{alias}{column} {op} ?')
+                params.append(value)
+        return ' AND '.join(conditions) or '1', params
+
+    def quests(self, since: float = None, until: float = None) -> Dict[str, Dict[str, Any]]:
+        """:return: {quest: {'battles', 'recognized', 'first', 'last', 'avg_duration', 'apples', 'crafts'}}"""
+        self.flush()
+        where, params = self._where(None, since, until)
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute(f'SELECT quest, COUNT(*), SUM(recognized), MIN(time), MAX(time), AVG(duration), '
+                                f'COUNT(apple), COUNT(craft_drop) FROM battles WHERE {where} GROUP BY quest',
+                                params).fetchall()
+        keys = ('battles', 'recognized', 'first', 'last', 'avg_duration', 'apples', 'crafts')
+        return {row[0]: dict(zip(keys, row[1:])) for row in rows}
+
+    def battles(self, quest: str = None, since: float = None, until: float = None, limit=100) -> List[Dict[str, Any]]:
+        """:return: latest battles with their drops"""
+        self.flush()
+        where, params = self._where(quest, since, until)
+        with contextlib.closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = [dict(row) for row in conn.execute(f'SELECT * FROM battles WHERE {where} ORDER BY time DESC '
+                                                      f'LIMIT ?', params + [limit])]
+            ids = [row['id'] for row in rows]
+            drops = conn.execute(f'SELECT battle_id, item, num FROM drops WHERE battle_id IN '
+                                 f'({",".join("?" * len(ids))})', ids).fetchall() if ids else []
+        items: Dict[str, Dict[str, int]] = {}
+        for battle_id, item_name, num in drops:
+            items.setdefault(battle_id, {})[item_name] = num
+        for row in rows:
+            row['drops'] = items.get(row['id'], {}) if row['recognized'] else None
+        return rows
+
+    def drop_rates(self, quest: str = None, since: float = None, until: float = None, z=1.96):
+        # type:(str,float,float,float)->Dict[str,Dict[str,Any]]
+        """
+        Drop rates of battles whose drops are recognized.
+
+        :param z: z-score of confidence interval, 1.96 for 95%.
+        :return: {quest: {'battles': n, 'items': {item: {'battles': k, 'num': total num,
+                 'rate': k/n, 'ci': Wilson interval of rate, 'per_battle': num/n}}}}
+        """
+        self.flush()
+        where, params = self._where(quest, since, until)
+        b_where, b_params = self._where(quest, since, until, 'b.')
+        with contextlib.closing(self._connect()) as conn:
+            battles = conn.execute(f'SELECT quest, COUNT(*) FROM battles WHERE recognized = 1 AND {where} '
+                                   f'GROUP BY quest', params).fetchall()
+            drops = conn.execute(f'SELECT b.quest, d.item, COUNT(*), SUM(d.num) FROM drops d '
+                                 f'JOIN battles b ON d.battle_id = b.id WHERE b.recognized = 1 AND {b_where} '
+                                 f'GROUP BY b.quest, d.item', b_params).fetchall()
+        results = {name: {'battles': n, 'items': {}} for name, n in battles}
+        for name, item_name, k, num in drops:
+            n = results[name]['battles']
+            results[name]['items'][item_name] = {'battles': k, 'num': num, 'rate': k / n,
+                                                 'ci': wilson_interval(k, n, z), 'per_battle': num / n}
+        return results
+
+
+_battle_store: Optional[BattleStore] = None
+
+
+def get_battle_store() -> Optional[BattleStore]:
+    """store at `config.battle_store`, None if disabled"""
+    global _battle_store
+    if config.battle_store is None:
+        return None
+    if _battle_store is None or _battle_store.fp != config.battle_store:
+        _battle_store = BattleStore(config.battle_store)
+    return _battle_store
+
+
+class DropsRecorder:
+    """Recognize drops of rewards screenshot in a background worker right after battle, and record to `BattleStore`"""
+
+    def __init__(self, directory: str, store: BattleStore, LOC: Regions = None):
+        """
+        :param directory: folder of item templates, see `DropsStat.save_item_templates`.
+        :param store: where battles are recorded.
+        :param LOC: regions of rewards page.
+        """
+        self.stat = DropsStat(LOC=LOC)
+        self.stat.load_item_dir(directory)
+        self.store = store
+        # one worker to keep records in order and not to compete with matching of battle
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='drops')
+
+    def submit(self, battle_id: str, rewards: ImageLike):
+        """:param rewards: screenshot of rewards page, arrays are copied since frames may be shared"""
+        if isinstance(rewards, numpy.ndarray):
+            rewards = numpy.array(rewards)
+        return self._executor.submit(self._record, battle_id, rewards)
+
+    def _record(self, battle_id: str, rewards: ImageLike):
+        try:
+            items = self.stat.recognize(rewards)
+            self.store.add_drops(battle_id, items)
+            logger.debug(f'drops of battle {battle_id}: {items}')
+        except Exception as e:  # noqa
+            logger.error(f'failed to recognize drops of battle {battle_id}: {e}')
+
+
 # %%
 if __name__ == '__main__':
     stat = DropsStat()
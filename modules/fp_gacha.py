@@ -14,7 +14,7 @@ class FpGacha(BaseAgent):
         # pre-processing
         self.pre_process(cfg)
         config.mail = config.fp_gacha.mail
-        self.LOC.relocate(config.fp_gacha.location)
+        self.locate(config.fp_gacha.location)
         self.T.read_templates(config.fp_gacha.dir)
         config.T = self.T
         config.LOC = self.LOC
@@ -47,15 +47,14 @@ class FpGacha(BaseAgent):
             if loops % 10 == 0:
                 logger.debug(f'fp gacha {loops}/{num}...')
             # wait_targets(T.fp_gacha_page, LOC.fp_gacha_logo, at=LOC.fp_gacha_point)
-            page_no = wait_which_target([T.gacha_fp_confirm, T.gacha_fp_result, T.gacha_fp_ce_full],
-                                        [LOC.gacha_fp_confirm, LOC.gacha_fp_result_summon, LOC.bag_full_sell_button],
-                                        clicking=LOC.gacha_fp_result_summon, interval=0.05, threshold=0.7)
-            if page_no == 0:
+            page = wait_page(['gacha_fp_confirm', 'gacha_fp_result', 'gacha_fp_ce_full'], T, LOC,
+                             clicking=LOC.gacha_fp_result_summon, interval=0.05)
+            if page == 'gacha_fp_confirm':
                 click(LOC.gacha_fp_confirm)
                 loops += 1
                 config.update_time()
                 config.count_fp_gacha()
-            elif page_no == 1:
+            elif page == 'gacha_fp_result':
                 click(LOC.gacha_fp_result_summon)
             else:
                 bag_no = wait_which_target([T.gacha_fp_svt_full, T.gacha_fp_ce_full], LOC.fp_bag_full_title)
@@ -72,10 +71,11 @@ class FpGacha(BaseAgent):
                     wait_targets(T.menu, LOC.menu_gacha_button, at=0)
                     while True:
                         wait_targets(T.gacha_quartz_page, LOC.gacha_help, lapse=0.2)
-                        shot = screenshot()
-                        if match_targets(shot, T.gacha_quartz_page, LOC.gacha_quartz_logo):
+                        shot = screenshot(as_array=True)
+                        page = classify_page(shot, ['gacha_quartz_page', 'gacha_fp_page'], T, LOC).name
+                        if page == 'gacha_quartz_page':
                             click(LOC.gacha_arrow_left)
-                        elif match_targets(shot, T.gacha_fp_page, LOC.gacha_fp_logo):
+                        elif page == 'gacha_fp_page':
                             logger.debug('back to fp gacha page, will start in 3 secs, don\'t move mouse now')
                             config.update_time(3)
                             time.sleep(3)
@@ -111,7 +111,7 @@ class FpGacha(BaseAgent):
                 logger.debug('choose enhancement target', extra=LOG_TIME)
                 click(LOC.ce_target_box)
                 wait_targets(T.ce_select_target, LOC.ce_select_mode)
-                shot = screenshot()
+                shot = screenshot(as_array=True)
                 for box in LOC.ce_targets:
                     if match_targets(shot, T.ce_select_target, box):
                         click(box)
@@ -14,7 +14,7 @@ class Lottery(BaseAgent):
         # pre-processing
         self.pre_process(cfg)
         config.mail = config.lottery.mail
-        self.LOC.relocate(config.lottery.location)
+        self.locate(config.lottery.location)
         self.T.read_templates(config.lottery.dir)
         config.T = self.T
         config.LOC = self.LOC
@@ -47,7 +47,7 @@ class Lottery(BaseAgent):
             # print(f'\r loop {loops:<4d}', end='')
             for _ in range(10):
                 click(LOC.lottery_point, lapse=0.05)
-            shot = screenshot()
+            shot = screenshot(as_array=True)
             if match_targets(shot, T.lottery_empty, LOC.lottery_empty) and \
                     not match_targets(shot, T.lottery_empty, LOC.lottery_reset_action):
                 config.mark_task_finish('Finished: tickets have been used up')
@@ -93,7 +93,9 @@ class Lottery(BaseAgent):
         drag_num = config.lottery.clean_drag_times
 
         def _is_match_offset(_shot, template, old_loc, _offset):
-            return match_targets(_shot.crop(numpy.add(old_loc, [0, _offset, 0, _offset])), template.crop(old_loc))
+            # cropped template is cached, see `template_data`
+            return match_targets(crop(_shot, numpy.add(old_loc, [0, _offset, 0, _offset])),
+                                 template_data(template, old_loc))
 
         no = 0
         skipped_drag_num = 0
@@ -121,9 +123,9 @@ class Lottery(BaseAgent):
                 while drag_no < drag_num and no < num:
                     drag_no += 1
                     sleep(0.2)
-                    shot = screenshot()
-                    peaks = search_peaks(shot.crop(LOC.mailbox_check_column),
-                                         T.mailbox_unselected1.crop(LOC.mailbox_first_checkbox))
+                    shot = screenshot(as_array=True)
+                    peaks = search_peaks(crop(shot, LOC.mailbox_check_column), T.mailbox_unselected1,
+                                         target_region=LOC.mailbox_first_checkbox)
                     for y_peak in peaks:
                         y_offset = y_peak - (LOC.mailbox_first_checkbox[1] - LOC.mailbox_check_column[1])
                         for mailbox_unselect in [T.mailbox_unselected1, T.mailbox_unselected2, T.mailbox_unselected3]:
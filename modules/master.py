@@ -4,13 +4,19 @@ additional, Card class included.
 """
 import contextlib
 import enum
+import hashlib
+import json
 
 from util.addon import *
 from util.autogui import *
 from util.config import *
+from .support_scanner import SupportScanner
 
 quartz_logger = get_logger_dispatcher('quartz', logging.DEBUG)
 
+# bump it if the format of card template cache changed, see `Master.set_cards_from_json`
+_CARD_CACHE_VERSION = 1
+
 
 class Card:
     NP = 0
@@ -75,9 +81,13 @@ class Master:
         # initiate inside BattleBase after pre_process
         self.LOC = Regions()
         self.card_templates: Dict[Card, List[Image.Image]] = {}
+        # card templates stacked by (is np card, size), rebuilt after card templates changed. See `parse_cards`
+        self._card_atlases: Optional[List[Tuple[bool, List[Card], TemplateAtlas]]] = None
         self.card_weights: Dict[Card, float] = {}
         self._wave_a = None
         self._wave_b = None
+        # apple eaten before the current battle, recorded in `BattleStore`
+        self.eaten_apple: Optional[int] = None
 
     def set_cards(self, svt, np, quick, arts, buster, images=None):
         # type:(str,Sequence,Sequence,Sequence,Sequence,ImageTemplates)->None
@@ -102,6 +112,7 @@ class Master:
                     img_name = f'cards{img_name}'
                 _templates.append(images.get(img_name).crop(self.LOC.cards[loc - 1]))
             self.card_templates[Card(svt, color)] = _templates
+        self._card_atlases = None
 
     def set_cards_from_json(self, svt: str, fp: str, key: str = None):
         """
@@ -117,7 +128,6 @@ class Master:
         :param key: svt key in json, default is `svt`
         :return:
         """
-        import json
         key = key or svt
         fp2 = f'img/share/{fp}/cards/_cards.json'
         if not os.path.exists(fp) and os.path.exists(fp2):
@@ -134,7 +144,51 @@ class Master:
                 img = prefix + img
                 loc = int(loc)
                 params[-1].append([img, loc])
-        self.set_cards(svt, *params, images=ImageTemplates(_folder))
+
+        # cropped templates are cached, rebuilt only if json, images or card regions changed
+        cache_fp = os.path.join(_folder, '_cache', f'cards-{hashlib.md5(key.encode()).hexdigest()[:8]}.npz')
+        sources = [fp] + [os.path.join(_folder, f'{img}.png') for pairs in params for img, _ in pairs]
+        signature = json.dumps({'version': _CARD_CACHE_VERSION, 'key': key, 'params': params,
+                                'regions': [list(r) for r in self.LOC.cards],
+                                'sources': [[os.path.basename(f), os.stat(f).st_mtime_ns, os.stat(f).st_size]
+                                            for f in sources if os.path.exists(f)]})
+        cached = self._load_card_cache(cache_fp, signature)
+        if cached is None:
+            self.set_cards(svt, *params, images=ImageTemplates(_folder))
+            self._save_card_cache(cache_fp, signature, [self.card_templates[Card(svt, c)] for c in range(4)])
+        else:
+            for color, _templates in enumerate(cached):
+                self.card_templates[Card(svt, color)] = _templates
+            self._card_atlases = None
+
+    @staticmethod
+    def _load_card_cache(fp: str, signature: str) -> Optional[List[List[Image.Image]]]:
+        """:return: templates of NP/Quick/Arts/Buster, None if cache not exists or outdated"""
+        if not os.path.exists(fp):
+            return None
+        try:
+            with numpy.load(fp) as f:
+                if str(f['signature']) != signature:
+                    return None
+                return [[Image.fromarray(f[f'{color}_{i}']) for i in range(int(f[f'num_{color}']))]
+                        for color in range(4)]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'invalid card template cache "{fp}", rebuild it: {e}')
+            return None
+
+    @staticmethod
+    def _save_card_cache(fp: str, signature: str, templates: List[List[Image.Image]]):
+        arrays = {'signature': numpy.array(signature)}
+        for color, _templates in enumerate(templates):
+            arrays[f'num_{color}'] = numpy.array(len(_templates))
+            for i, template in enumerate(_templates):
+                arrays[f'{color}_{i}'] = ImageTemplates.region_data(template, None, 'rgb')
+        try:
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+            with open(fp, 'wb') as f:
+                numpy.savez(f, **arrays)
+        except OSError as e:
+            logger.warning(f'failed to save card template cache "{fp}": {e}')
 
     def set_card_weight(self, weights: Union[Sequence, Dict[str, Union[float, List]]], color_weight: str = 'QAB'):
         """
@@ -237,7 +291,7 @@ class Master:
                 time.sleep(dt)
                 return
             elif apple in (0, 1, 2, 3):
-                if match_targets(screenshot(), T.apple_page, LOC.apples[apple]):
+                if match_targets(screenshot(as_array=True), T.apple_page, LOC.apples[apple]):
                     eaten = False
                     while True:
                         page_no = wait_which_target([T.apple_page, T.apple_confirm, T.support],
@@ -251,6 +305,8 @@ class Master:
                         elif page_no == 1:
                             click(LOC.apple_confirm, lapse=1)
                         elif page_no == 2:
+                            if eaten:
+                                self.eaten_apple = apple
                             if apple == 0:
                                 config.battle.quartz_eaten += 1
                                 quartz_logger.info(f'Account {config.id}: '
@@ -285,64 +341,36 @@ class Master:
         if switch_classes is None:
             switch_classes = (-1,)
         wait_targets(support0, LOC.support_refresh)
-        while numpy.mean(get_mean_color(screenshot(), LOC.loading_line)) > 200:
-            sleep(0.2)
+        poller = FramePoller(LOC.loading_line)
+        while numpy.mean(get_mean_color(poller.next(), LOC.loading_line)) > 200:
+            pass
         refresh_times = 0
 
-        def _is_match_offset(_support, _shot, old_loc, _offset, threshold=None):
-            if threshold is None:
-                threshold = 0.7
-            return match_targets(_shot.crop(numpy.add(old_loc, [0, _offset, 0, _offset])), _support.crop(old_loc),
-                                 threshold=threshold)
-
-        # lambda functions: function(support, screenshot, offset) -> matched or not
-        matches = [
-            lambda _p, _s, _o: not match_svt or _is_match_offset(_p, _s, LOC.support_skill, _o),
-            lambda _p, _s, _o: not match_skills or False not in [_is_match_offset(_p, _s, loc, _o) for loc in
-                                                                 LOC.support_skills],
-            lambda _p, _s, _o: not match_ce or _is_match_offset(_p, _s, LOC.support_ce[0], _o),
-            # ce_max rect is to small, may has lower similarity
-            lambda _p, _s, _o: not match_ce_max or _is_match_offset(_p, _s, LOC.support_ce_max[0], _o, 0.7),
-            lambda _p, _s, _o: not friend_only or _is_match_offset(_p, _s, LOC.support_friend_icon, _o),
-        ]
+        scanner = SupportScanner(supports, LOC, match_svt, match_skills, match_ce, match_ce_max, friend_only)
 
         while True:
             wait_targets(support0, LOC.support_class_affinity)
             for class_icon in switch_classes:
-                if class_icon == -1:
-                    sleep(0.2)
-                else:
+                if class_icon != -1:
                     click(LOC.support_class_icons[class_icon])
                     class_name = ['All', 'Saber', 'Archer', 'Lancer', 'Rider',
                                   'Caster', 'Assassin', 'Berserker', 'Extra', 'Mix'][class_icon]
                     logger.debug(f'switch support class to No.{class_icon}-{class_name}.')
                 click(LOC.support_scrollbar_start)
-                shot = screenshot()
+                # list changed or jumped to top, wait until it's settled rather than fixed sleep
+                scanner.tracker.reset()
+                shot = scanner.tracker.wait_settled()
                 drag_x, drag_y1 = LOC.support_scrollbar_start
                 drag_y2 = LOC.support_scrollbar_end[1]
-                drag_point_num = 6 if min(numpy.mean(shot.crop(LOC.support_scrollbar_head).getdata(), 0)) > 225 else 1
+                drag_point_num = 6 if min(get_mean_color(shot, LOC.support_scrollbar_head)) > 225 else 1
                 drag_points = [(drag_x, drag_y1 + (drag_y2 - drag_y1) / 8 * i) for i in range(drag_point_num)]
                 for i_point in range(drag_point_num):
-                    shot = screenshot()
-                    y_peaks = search_peaks(shot.crop(LOC.support_team_column), support0.crop(LOC.support_team_icon))
-                    for y_peak in y_peaks:
-                        y_offset = y_peak - (LOC.support_team_icon[1] - LOC.support_team_column[1])
-                        matched = False
-                        matched_support = -1
-                        for support_index, support in enumerate(supports):
-                            for func in matches:
-                                matched = func(support, shot, y_offset)
-                                if not matched:  # one condition not match-> false next support image
-                                    break
-                            if matched:  # one support matched
-                                matched_support = support_index
-                                if len(supports) > 1:
-                                    logger.info(f'matched support {support_index}')
-                                break
-                        if not matched:  # this friend not match any support, next friend
+                    for y_offset, matched_support in scanner.scan(shot):
+                        if matched_support < 0:  # this friend not match any support, next friend
                             continue
-                        click((LOC.width / 2, LOC.support_team_column[1] + y_peak
-                               + LOC.support_team_icon[3] - LOC.support_team_icon[1]))
+                        if len(supports) > 1:
+                            logger.info(f'matched support {matched_support}')
+                        click((LOC.width / 2, LOC.support_team_icon[3] + y_offset))
                         logger.debug('found support.', extra=LOG_TIME)
                         while True:
                             page_no = wait_which_target([T.team, T.wave1a],
@@ -356,8 +384,8 @@ class Master:
                                 return matched_support
                     # no friends matched, drag downward
                     if i_point + 1 < drag_point_num:
-                        drag(drag_points[i_point], drag_points[i_point + 1], 0.2)
-                        sleep(0.4)
+                        drag(drag_points[i_point], drag_points[i_point + 1], 0.2, lapse=0)
+                        shot = scanner.tracker.wait_settled()
             # refresh support
             refresh_times += 1
             logger.debug(f'refresh support {refresh_times} times...', extra=LOG_TIME)
@@ -367,6 +395,7 @@ class Master:
             wait_targets(T.support_confirm, LOC.support_confirm_title, clicking=LOC.support_refresh)
             click(LOC.support_refresh_confirm)
             wait_targets(support0, LOC.support_class_affinity, lapse=0.2)
+            scanner.reset()
 
     @contextlib.contextmanager
     def set_waves(self, before: Image.Image, after: Image.Image = None):
@@ -422,12 +451,12 @@ class Master:
         region = LOC.skills[who - 1][skill - 1]
         wait_targets(before, region, at=0, lapse=1)
         if friend is None:
-            while match_targets(screenshot(), before, region, 0.7):
-                if after is not None and match_targets(screenshot(), after, region):
+            while match_targets(screenshot(as_array=True), before, region, 0.7):
+                if after is not None and match_targets(screenshot(as_array=True), after, region):
                     break
                 click(region, 1)
         else:
-            while not match_targets(screenshot(), T.skill_targets, LOC.skill_targets_close, 0.7):
+            while not match_targets(screenshot(as_array=True), T.skill_targets, LOC.skill_targets_close, 0.7):
                 click(region, 1)
             click(LOC.skill_to_target[friend - 1])
         if after is not None and no_wait is False:
@@ -480,7 +509,7 @@ class Master:
                 click(LOC.master_skill)
             flag += 1
             sleep(0.6)
-            if match_targets(screenshot(), before, region):
+            if match_targets(screenshot(as_array=True), before, region):
                 click(region, 0)
                 break
 
@@ -502,14 +531,14 @@ class Master:
     def goto_parse_cards(self):
         t0 = time.time()
         while True:
-            shot = screenshot()
+            shot = screenshot(as_array=True)
             if match_targets(shot, self.T.wave1a, self.LOC.attack):
                 click(self.LOC.attack)
             elif match_targets(shot, self.T.cards1, self.LOC.cards_back):
                 break
         sleep(1)
         while True:
-            cards, np_cards = self.parse_cards(screenshot())
+            cards, np_cards = self.parse_cards(screenshot(as_array=True))
             if cards == {} or Card.UNKNOWN in [c.svt for c in cards.values()]:
                 if time.time() - t0 > 5 or self.card_templates == {}:
                     break
@@ -529,10 +558,10 @@ class Master:
         """
         logger.info(f'Auto attack: nps={nps}, mode={mode}', extra=LOG_TIME)
         t0 = time.time()
-        while not match_targets(screenshot(), self.T.cards1, self.LOC.cards_back):
+        while not match_targets(screenshot(as_array=True), self.T.cards1, self.LOC.cards_back):
             click(self.LOC.attack, lapse=1)  # self.LOC.attack should be not covered by self.LOC.cards_back
         while True:
-            cards, np_cards = self.parse_cards(screenshot(), nps=nps if parse_np else None)
+            cards, np_cards = self.parse_cards(screenshot(as_array=True), nps=nps if parse_np else None)
             # print('in auto_attack: ', cards, np_cards)
             chosen_cards = []
             if cards == {} or Card.UNKNOWN in [c.svt for c in cards.values()]:
@@ -557,8 +586,9 @@ class Master:
         # type:(Union[Image.Image,Sequence[Image.Image]],Sequence,AttackMode,int,bool,Union[int,Sequence])->List[List]
         cur_turn = 0
         turn_cards = []
+        poller = FramePoller(max_interval=0.5)
         while cur_turn < turns:
-            shot = screenshot()
+            shot = poller.next()
             if match_targets(shot, target, regions):
                 # this part must before elif part
                 if cur_turn > 0:
@@ -580,12 +610,12 @@ class Master:
         logger.info(f'Attack: cards={locs_or_cards}', extra=LOG_TIME)
         while True:
             click(self.LOC.attack, lapse=1)
-            if match_targets(screenshot(), self.T.cards1, self.LOC.cards_back):
+            if match_targets(screenshot(as_array=True), self.T.cards1, self.LOC.cards_back):
                 sleep(1, 0.5)
                 self.play_cards(locs_or_cards)
                 break
 
-    def parse_cards(self, img: Image.Image, nps: List[int] = None) -> Tuple[Dict[int, Card], Dict[int, Card]]:
+    def parse_cards(self, img: ImageLike, nps: List[int] = None) -> Tuple[Dict[int, Card], Dict[int, Card]]:
         """
         Recognize the cards of current screenshot.
 
@@ -596,49 +626,38 @@ class Master:
         if self.card_templates == {}:
             return {}, {}
         nps = convert_to_list(nps)
-        base_line = -1
+        if isinstance(img, Image.Image):
+            img = numpy.asarray(img.convert('RGB'))
+
+        atlases = self._get_card_atlases()
 
-        def _traverse(outer, mode):
-            # mode=0-all,1-common card,2-np card
-            nonlocal base_line  # to decrease time of `search_target()`
+        def _traverse(loc):
+            # common cards at loc 1~5, np cards at loc 6~8
+            outer = crop(img, self.LOC.cards_outer[loc - 1])
             threshold = 0.5
             _matched = None
-            max_th = 0
-            values = []
-            for card, templates in self.card_templates.items():
-                if mode == 1 and card.color == Card.NP:
+            max_th = threshold
+            for is_np, atlas_cards, atlas in atlases:
+                if is_np != (loc > 5):
                     continue
-                elif mode == 2 and card.color != Card.NP:
-                    continue
-                for template in templates:
-                    # if base_line > 0:
-                    #     # enhancement: from 0.95s->0.7s....
-                    #     box = (0, max([0, base_line - 10]),
-                    #            outer.size[0], min([base_line + template.size[1] + 10, outer.size[1]]))
-                    #     cropped_outer = outer.crop(box)
-                    # else:
-                    #     cropped_outer = outer
-                    th, pos = search_target(outer, template)
-                    values.append(th)
-                    if th > threshold and th > max_th:
-                        if base_line < 0:
-                            base_line = pos[1]
-                        max_th = th
-                        _matched = Card(card.svt, card.color)
+                # all templates are scored in one pass, max score of every template
+                ths = atlas.scores(outer).max(1)
+                best = int(numpy.argmax(ths))
+                if ths[best] > max_th:
+                    max_th = ths[best]
+                    _matched = Card(atlas_cards[best].svt, atlas_cards[best].color)
+            if _matched is None:
+                return Card(Card.UNKNOWN, -1, loc)
+            _matched.loc = loc
             return _matched
 
+        # every card slot is scored on the shared thread pool, FFT and matmul release the GIL
         cards, np_cards = {}, {}
-        for loc in range(1, 9):
-            base_line = -1  # reset every card
-            matched = _traverse(img.crop(self.LOC.cards_outer[loc - 1]), 1 if loc <= 5 else 2)
-            if matched is None:
-                matched = Card(Card.UNKNOWN, -1, loc)
+        for matched in get_match_executor().map(_traverse, range(1, 9)):
+            if matched.loc <= 5:
+                cards[matched.loc] = matched
             else:
-                matched.loc = loc
-            if loc <= 5:
-                cards[loc] = matched
-            else:
-                np_cards[loc] = matched
+                np_cards[matched.loc] = matched
         for x in [cards, np_cards]:
             if False not in [card.svt == Card.UNKNOWN for card in x.values()]:
                 # all cards are not recognized.
@@ -651,6 +670,16 @@ class Master:
                          f' nps={self.str_cards(np_cards)}', extra=LOG_TIME)
         return cards, np_cards
 
+    def _get_card_atlases(self) -> List[Tuple[bool, List[Card], TemplateAtlas]]:
+        if self._card_atlases is None:
+            groups: Dict[Tuple[bool, Tuple[int, int]], List[Tuple[Card, Image.Image]]] = {}
+            for card, templates in self.card_templates.items():
+                for template in templates:
+                    groups.setdefault((card.color == Card.NP, template.size), []).append((card, template))
+            self._card_atlases = [(is_np, [card for card, _ in pairs], TemplateAtlas([t for _, t in pairs]))
+                                  for (is_np, _), pairs in groups.items()]
+        return self._card_atlases
+
     def choose_cards(self, cards, np_cards, nps=None, mode=AttackMode.damage, buster_first=False):
         # type:(Dict[int,Card],Dict[int,Card],Union[List[int],int],AttackMode,bool)->List[Card]
         """
@@ -718,15 +747,15 @@ class Master:
             # print(f'click card {loc}')
             click(self.LOC.cards[loc - 1], lapse=0.3)
         time.sleep(1)
-        if match_targets(screenshot(), self.T.cards1, self.LOC.cards_back):
+        if match_targets(screenshot(as_array=True), self.T.cards1, self.LOC.cards_back):
             # if np card is not clicked, try again
             for loc in locs:
                 if loc in (6, 7, 8):
                     click(self.LOC.cards[loc - 1], lapse=0.3)
 
-    def check_rewards(self, img: Image.Image = None, check_type: int = 0):
+    def check_rewards(self, img: ImageLike = None, check_type: int = 0):
         if img is None:
-            img = screenshot()
+            img = screenshot(as_array=True)
         if check_type == 0:
             return False
         elif check_type == 1:
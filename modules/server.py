@@ -120,7 +120,7 @@ def get_image_folder_tree():
         return wrap_response(None, False, 'Empty image folder')
     for dir_path, dir_names, filenames in os.walk(img_folder):
         key = os.path.relpath(os.path.realpath(dir_path), img_folder)
-        filenames = [f for f in filenames if f.rsplit('.')[-1].lower() in ['png', 'jpg', 'jpeg']]
+        filenames = [f for f in filenames if f.rsplit('.')[-1].lower() in ['png', 'jpg', 'jpeg', 'webp']]
         if key == '.':
             key = ''
         key = key.strip('\\/').replace('\\', '/')
@@ -154,6 +154,37 @@ def get_file():
     return Response(compress_image(image, quality=60).getvalue(), mimetype="image/jpeg")
 
 
+def _battle_store_query(method: str, **kwargs):
+    """query `BattleStore` with common args: quest, since and until(unix timestamp)"""
+    from modules.drops_stat import get_battle_store
+    store = get_battle_store()
+    if store is None:
+        return wrap_response(None, False, 'battle store is disabled')
+    if method != 'quests':
+        kwargs['quest'] = request.args.get('quest') or None
+    kwargs['since'] = request.args.get('since', type=float)
+    kwargs['until'] = request.args.get('until', type=float)
+    return wrap_response(getattr(store, method)(**kwargs))
+
+
+@app.route('/getQuests')
+def get_quests():
+    """Battles summary of every quest"""
+    return _battle_store_query('quests')
+
+
+@app.route('/getBattles')
+def get_battles():
+    """Latest battles with drops, args: quest, since, until, limit(default 100)"""
+    return _battle_store_query('battles', limit=request.args.get('limit', 100, type=int))
+
+
+@app.route('/getDropStats')
+def get_drop_stats():
+    """Drop rates and Wilson confidence intervals of quests, args: quest, since, until, z(default 1.96 for 95%)"""
+    return _battle_store_query('drop_rates', z=request.args.get('z', 1.96, type=float))
+
+
 @app.route('/getTaskStatus')
 def get_task_status():
     return wrap_response(f'Current task thread: {repr(config.task_thread)}')
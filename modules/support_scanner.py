@@ -0,0 +1,203 @@
+"""
+Scanner of support list, see `Master.choose_support`.
+"""
+import time
+import zlib
+from concurrent.futures import Future
+
+from util.autogui import *
+from util.config import *
+
+
+class ScrollTracker:
+    """
+    Track the vertical scroll position of a list by phase correlation of consecutive frames at `region`.
+
+    `position` is the total scrolled pixels since the last anchor, increasing when the list scrolls down(contents
+    move up). It's used to tell when the list is settled, see `wait_settled`.
+    If two frames don't overlap(response of phase correlation is low) or the shift is ambiguous, tracking is lost and
+    re-anchored: `anchor` is increased and positions of different anchors are not comparable.
+    Rows of a list look alike, phase correlation only finds the shift modulo the row pitch. So shifts near or above
+    half of the window or of the row pitch are treated as lost, and the estimated shift must align two frames.
+    """
+
+    def __init__(self, region: Sequence, scale=0.5, min_response=0.1, period: float = None, max_residual=12.0):
+        """
+        :param region: region of the list in screenshot.
+        :param scale: frames are downscaled before correlation.
+        :param min_response: min peak response of phase correlation to treat frames as overlapped.
+        :param period: row pitch of list in pixels, if rows look alike.
+        :param max_residual: max mean difference of gray value in any block of aligned frames in the overlapped area.
+        """
+        self.region = region
+        self.scale = scale
+        self.min_response = min_response
+        self.period = period
+        self.max_residual = max_residual
+        self.position = 0.0
+        self.anchor = 0
+        self.frame = None  # last tracked frame
+        self._last = None
+        self._window = None
+
+    def reset(self):
+        """re-anchor at the next frame, e.g. list refreshed or jumped to top"""
+        self.position = 0.0
+        self.anchor += 1
+        self.frame = None
+        self._last = None
+
+    def update(self, shot: numpy.ndarray) -> Optional[float]:
+        """
+        Track a new frame.
+
+        :return: scrolled pixels since the last frame, None if it's the first frame or tracking is lost.
+        """
+        gray = cv2.cvtColor(numpy.ascontiguousarray(crop(shot, self.region)), cv2.COLOR_RGB2GRAY)
+        gray = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA).astype(numpy.float32)
+        last, self._last, self.frame = self._last, gray, shot
+        if last is None or last.shape != gray.shape:
+            return None
+        if self._window is None or self._window.shape != gray.shape:
+            self._window = cv2.createHanningWindow((gray.shape[1], gray.shape[0]), cv2.CV_32F)
+        (_, dy), response = cv2.phaseCorrelate(last, gray, self._window)
+        if response < self.min_response or not self._aligned(last, gray, -dy):
+            self.position = 0.0
+            self.anchor += 1
+            return None
+        shift = -dy / self.scale
+        self.position += shift
+        return shift
+
+    def _aligned(self, last: numpy.ndarray, gray: numpy.ndarray, shift: float) -> bool:
+        """whether the shift(of downscaled frames) is unambiguous and `gray` is `last` moved up by it"""
+        height = gray.shape[0]
+        limit = height / 2
+        if self.period:
+            limit = min(limit, self.period * self.scale / 2)
+        if abs(shift) >= limit:
+            return False
+        moved = cv2.warpAffine(last, numpy.float32([[1, 0, 0], [0, 1, -shift]]), (last.shape[1], height))
+        margin = int(numpy.ceil(abs(shift))) + 1
+        overlap = slice(0, height - margin) if shift >= 0 else slice(margin, height)
+        residual = numpy.abs(moved[overlap] - gray[overlap])
+        # rows differ in small parts(avatar, skills), compare mean residual of blocks rather than the whole
+        blocks = cv2.resize(residual, (max(1, residual.shape[1] // 8), max(1, residual.shape[0] // 8)),
+                            interpolation=cv2.INTER_AREA)
+        return float(blocks.max()) <= self.max_residual
+
+    def wait_settled(self, interval=0.05, stable=2, tolerance=0.5, timeout=0.4) -> numpy.ndarray:
+        """
+        Poll screenshots until the list stops scrolling, which replaces fixed sleeps after dragging.
+
+        :param stable: settled if the list doesn't move in `stable` consecutive frames.
+        :param tolerance: max shift in pixels of a static frame.
+        :param timeout: return the latest frame anyway after timeout, e.g. animated rows never look static.
+        :return: the settled frame.
+        """
+        end_time = time.time() + timeout
+        count = 0
+        shot = None
+        while count < stable and time.time() < end_time:
+            time.sleep(interval)
+            shot = screenshot(fresh=True, as_array=True)
+            shift = self.update(shot)
+            count = count + 1 if shift is not None and abs(shift) <= tolerance else 0
+        return shot if shot is not None else screenshot(fresh=True, as_array=True)
+
+
+class SupportScanner:
+    """
+    Match rows of support list against support templates.
+
+    Rows are found by one `search_peaks` pass over the team column, then sub-regions(skills, CE, friend icon...)
+    of all rows are scored against all support templates in one batch on the shared match executor.
+    Results are memorized by pixels of the row, rows revealed again after scrolling are not scored again.
+    `tracker` only tells when the list is settled after clicking or dragging.
+    """
+
+    def __init__(self, supports, LOC, match_svt=True, match_skills=True, match_ce=False, match_ce_max=False,
+                 friend_only=False, threshold=0.7):
+        # type:(Sequence[ImageLike],Regions,bool,bool,bool,bool,bool,float)->None
+        """
+        :param supports: support page templates, rows are located by the team icon of the first one.
+        :param threshold: min similarity of every sub-region. CE max rect is small and may have lower similarity.
+        Other params see `Master.choose_support`.
+        """
+        self.supports = list(supports)
+        self.LOC = LOC
+        regions = []
+        if match_svt:
+            regions.append(LOC.support_skill)
+        if match_skills:
+            regions.extend(LOC.support_skills)
+        if match_ce:
+            regions.append(LOC.support_ce[0])
+        if match_ce_max:
+            regions.append(LOC.support_ce_max[0])
+        if friend_only:
+            regions.append(LOC.support_friend_icon)
+        # sub-regions in the row of templates
+        self.regions = [tuple(int(round(v)) for v in region) for region in regions]
+        self.threshold = threshold
+        # {fingerprint of row: matched support index or -1}
+        self._memo: Dict[int, int] = {}
+        column = LOC.support_team_column
+        self.tracker = ScrollTracker((LOC.support_ce[0][0], column[1], column[2], column[3]),
+                                     period=LOC.support_ce[1][1] - LOC.support_ce[0][1])
+
+    def reset(self):
+        """forget scored rows, e.g. after support list refreshed"""
+        self._memo.clear()
+        self.tracker.reset()
+
+    def find_rows(self, shot: numpy.ndarray) -> List[int]:
+        """:return: y offsets of rows in `shot` relative to the row in templates, from top to bottom"""
+        LOC = self.LOC
+        y_peaks = search_peaks(crop(shot, LOC.support_team_column), self.supports[0],
+                               target_region=LOC.support_team_icon)
+        base = LOC.support_team_icon[1] - LOC.support_team_column[1]
+        return [int(y_peak) - base for y_peak in y_peaks]
+
+    def _row_crops(self, shot: numpy.ndarray, offset: int) -> Optional[List[numpy.ndarray]]:
+        """sub-regions of row at offset, None if the row is partially out of screen"""
+        crops = []
+        for x0, y0, x1, y1 in self.regions:
+            cropped = crop(shot, (x0, y0 + offset, x1, y1 + offset))
+            if cropped.shape[:2] != (y1 - y0, x1 - x0):
+                return None
+            crops.append(numpy.ascontiguousarray(cropped))
+        return crops
+
+    def scan(self, shot: numpy.ndarray, offsets: Sequence[int] = None) -> List[Tuple[int, int]]:
+        """
+        :param shot: RGB array of screenshot.
+        :param offsets: row offsets, default `find_rows(shot)`.
+        :return: list of (offset, matched support index or -1) of every row.
+        """
+        if offsets is None:
+            offsets = self.find_rows(shot)
+        if not self.regions:
+            return [(offset, 0) for offset in offsets]
+        results: Dict[int, int] = {}
+        pending: Dict[int, Tuple[int, List[Future]]] = {}
+        executor = get_match_executor()
+        for offset in offsets:
+            crops = self._row_crops(shot, offset)
+            if crops is None:
+                results[offset] = -1
+                continue
+            key = 0
+            for cropped in crops:
+                key = zlib.crc32(cropped, key)
+            if key in self._memo:
+                results[offset] = self._memo[key]
+                continue
+            futures = [executor.submit(cal_sim, cropped, template_data(support, region, 'rgb'))
+                       for support in self.supports for cropped, region in zip(crops, self.regions)]
+            pending[offset] = (key, futures)
+        for offset, (key, futures) in pending.items():
+            scores = numpy.reshape([future.result() for future in futures], (len(self.supports), len(self.regions)))
+            matched = numpy.flatnonzero(numpy.all(scores >= self.threshold, axis=1))
+            results[offset] = self._memo[key] = int(matched[0]) if len(matched) > 0 else -1
+        return [(offset, results[offset]) for offset in offsets]
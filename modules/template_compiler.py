@@ -0,0 +1,88 @@
+"""
+Precompile template images into one binary bundle, see `TemplateBundle`.
+
+Run `python main.py compile`, the bundle is saved at `config.template_bundle` and loaded in `pre_process`.
+"""
+import re
+
+from util.pages import *
+from .base_agent import BaseAgent
+
+
+class TemplateCompiler(BaseAgent):
+    # data kinds precomputed for every (template, region) pair
+    kinds = ('rgb', 'gray', 'hash', 'hist')
+
+    def start(self, timeout=None, cfg=None):
+        config.load(cfg)
+        logger.set_cur_logger('compile')
+        fp = config.template_bundle
+        self.compile(fp, self.template_dirs())
+        ImageTemplates.load_bundle(fp)
+
+    @staticmethod
+    def template_dirs() -> List[str]:
+        """`img/share/*`, `img/battles/*` and template dirs of lottery and fp gacha in config"""
+        dirs = []
+        for root in ('img/share', 'img/battles'):
+            if os.path.isdir(root):
+                dirs.extend(os.path.join(root, d) for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+        for _dir in (config.lottery.dir, config.fp_gacha.dir):
+            if _dir is not None and os.path.isdir(_dir):
+                dirs.append(_dir)
+        return dirs
+
+    @staticmethod
+    def collect_regions(filepath: str) -> List[Tuple[int, ...]]:
+        """
+        Regions referenced by the template:
+            - regions of registered pages and `register_template_regions`, see `util.pages`
+            - the `Regions` attribute of the same name
+            - `Regions.cards` for images in "cards" folder
+            - regions used in previous runs, which are cached in "_cache" folder, see `LazyImage`.
+        Both regions of CN and JP are included.
+        """
+        folder, filename = os.path.split(filepath)
+        name = filename[:-4]
+        regions = []
+        for LOC in (Regions(), Regions(True)):
+            regions.extend(template_regions(name, LOC))
+            value = getattr(LOC, name, None)
+            if isinstance(value, (list, tuple)) and value:
+                regions.extend(value if isinstance(value[0], (list, tuple)) else [value])
+            if os.path.basename(folder) == 'cards':
+                regions.extend(LOC.cards)
+        cache_dir = os.path.join(folder, '_cache')
+        if os.path.isdir(cache_dir):
+            stat = os.stat(filepath)
+            stem = f'{name}-{stat.st_mtime_ns:x}-{stat.st_size:x}-'
+            for fn in os.listdir(cache_dir):
+                matched = re.match(r'(-?\d+)_(-?\d+)_(-?\d+)_(-?\d+)\.npy$', fn[len(stem):])
+                if fn.startswith(stem) and matched:
+                    regions.append([int(v) for v in matched.groups()])
+        return sorted(set(tuple(int(round(v)) for v in r) for r in regions if len(r) == 4))
+
+    def compile(self, fp: str, dirs: Sequence[str]):
+        templates = {}
+        pairs = 0
+        for _dir in dirs:
+            for root, _, files in os.walk(_dir):
+                for fn in files:
+                    if not fn.endswith('.png') or os.path.basename(root) == '_cache':
+                        continue
+                    filepath = os.path.join(root, fn)
+                    regions = self.collect_regions(filepath)
+                    if not regions:
+                        continue
+                    image = Image.open(filepath)
+                    image.load()
+                    data = {}
+                    for region in regions:
+                        cropped = image.crop(region).convert('RGB')
+                        rgb = numpy.array(cropped)
+                        data[TemplateBundle.region_key(region)] = {
+                            kind: ImageTemplates.derive_region_data(rgb, kind) for kind in self.kinds}
+                    templates[filepath] = (image.size, data)
+                    pairs += len(regions)
+        TemplateBundle.write(fp, templates)
+        logger.info(f'compiled {len(templates)} templates, {pairs} regions into "{fp}"')
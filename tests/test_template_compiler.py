@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+
+import numpy
+from PIL import Image
+
+from modules.template_compiler import TemplateCompiler
+from util.dataset import Regions, TemplateBundle
+
+
+class TestTemplateCompiler(unittest.TestCase):
+    def test_compile_declared_pairs_without_cache(self):
+        LOC = Regions()
+        # (template, region) pairs used by the code but neither pages nor same-name regions
+        pairs = [('wave1a', LOC.attack), ('cards1', LOC.cards_back), ('support', LOC.support_class_affinity),
+                 ('support', LOC.support_team_icon)] + [('apple_page', region) for region in LOC.apples]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            folder = os.path.join(tmp_dir, 'battle')
+            os.makedirs(folder)
+            image = numpy.random.default_rng(0).integers(0, 255, (LOC.height, LOC.width, 3), dtype=numpy.uint8)
+            for name in set(name for name, _ in pairs):
+                Image.fromarray(image).save(os.path.join(folder, f'{name}.png'))
+            self.assertFalse(os.path.exists(os.path.join(folder, '_cache')))
+            fp = os.path.join(tmp_dir, 'templates.bin')
+            TemplateCompiler().compile(fp, [folder])
+            bundle = TemplateBundle(fp)
+            for name, region in pairs:
+                data = bundle.get(os.path.join(folder, f'{name}.png'), region, 'rgb')
+                self.assertIsNotNone(data, f'{name}@{region} not compiled')
+                x0, y0, x1, y1 = region
+                numpy.testing.assert_array_equal(data, image[y0:y1, x0:x1])
+
+
+if __name__ == '__main__':
+    unittest.main()
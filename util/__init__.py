@@ -9,6 +9,7 @@ from . import config
 from . import dataset
 from . import gui
 from . import log
+from . import pages
 from . import supervisor
 
 __all__ = [
@@ -19,5 +20,6 @@ __all__ = [
     'dataset',
     'gui',
     'log',
+    'pages',
     'supervisor',
 ]
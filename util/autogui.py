@@ -1,5 +1,9 @@
 """Image related processing"""
+import atexit
 import io
+import queue
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import imagehash as imagehash
@@ -15,89 +19,281 @@ from .gui import *
 from .log import *
 
 _screenshot_locker = threading.Lock()
+_match_executor: Optional[ThreadPoolExecutor] = None
+_image_writer = None  # type: Optional[ImageWriter]
+
+
+# image could be PIL.Image.Image, LazyImage(templates) or RGB numpy array(h,w,3), e.g. `screenshot(as_array=True)`
+ImageLike = Union[Image.Image, LazyImage, numpy.ndarray]
 
 
 # %% image processing
-def get_mean_color(img: Image.Image, region: Sequence):
-    if len(region) == 2:
+def crop(img: ImageLike, region: Sequence = None) -> ImageLike:
+    """
+    Crop PIL image or numpy array at region(left, top, right, bottom).
+    Array is sliced as a view without copy, and the part outside image is dropped rather than padded as PIL.
+    """
+    if region is None:
+        return img
+    if not isinstance(img, numpy.ndarray):
+        return img.crop(region)
+    x0, y0, x1, y1 = [int(round(v)) for v in region]
+    return img[max(0, y0):max(0, y1), max(0, x0):max(0, x1)]
+
+
+def get_mean_color(img: ImageLike, region: Sequence):
+    if isinstance(img, numpy.ndarray):
+        if len(region) == 2:
+            return tuple(int(v) for v in img[int(region[1]), int(region[0])])
+        elif len(region) == 4:
+            cropped = crop(img, region)
+            return numpy.mean(cropped.reshape(-1, cropped.shape[-1]), 0)
+    elif len(region) == 2:
         return img.getpixel(region)
     elif len(region) == 4:
         return numpy.mean(list(img.crop(region).getdata()), 0)
-    else:
-        raise KeyError(f'len(region) != 2 or 4. region={region}')
+    raise KeyError(f'len(region) != 2 or 4. region={region}')
+
+
+def template_data(template: ImageLike, region: Sequence = None, kind: str = 'rgb'):
+    """
+    Cached data of template at frame `region`, see `ImageTemplates.region_data`.
+
+    Templates are captured at the default layout(`Regions.box`). If regions are relocated into another box of frame
+    (`config.LOC.box`, see `Regions.relocate`), template is cropped at the default region which `region` is relocated
+    from, and resized to the size of `region`.
+    """
+    LOC = config.LOC
+    if region is None or LOC is None or tuple(LOC.box) == tuple(Regions.box):
+        return ImageTemplates.region_data(template, region, kind)
+    x0, y0, x1, y1 = [int(round(v)) for v in region]
+    source = Regions.relocate_one((x0, y0, x1, y1), Regions.box, LOC.box)
+    return ImageTemplates.region_data(template, source, kind, (x1 - x0, y1 - y0))
 
 
-def cal_sim(img1: Image.Image, img2: Image.Image, region=None, method=None) -> float:
+def cal_sim(img1: ImageLike, img2: ImageLike, region=None, method=None) -> float:
     """
     Calculate the similarity of two image at region.
 
-    :param img1:
-    :param img2:
-    :param region: region to crop.
+    :param img1: usually the screenshot.
+    :param img2: usually the template, its cropped arrays are cached, see `template_data`.
+    :param region: region to crop, template is cropped at the region of default layout if relocated.
     :param method: 'template': cv2.matchTemplate, crop one slightly
                    'ssim': compute the mean structural similarity using `skimage`,
+                   'ssim_fast': mean structural similarity of grayscale and downscaled crops,
+                                template statistics are cached, much faster than 'ssim'.
                    'hist': compute the similarity of color histogram,
                    'hash': image hash, value may be larger as expected.
     :return: similarity, float less than 1, may be negative.
     """
-    if region is not None:
-        img1 = img1.crop(region)
-        img2 = img2.crop(region)
-    if img1.width < img2.width:
-        img2 = img2.resize((img1.width, img1.height))
-    else:
-        img1 = img1.resize((img2.width, img2.height))
-    if img1.mode != 'RGB':
-        img1 = img1.convert('RGB')
-    if img2.mode != 'RGB':
-        img2 = img2.convert('RGB')
+    if method is None:
+        method = config.sim_algo or 'ssim'
+    assert method in ('template', 'ssim', 'ssim_fast', 'hist', 'hash'), method
+    m1 = _image_array(crop(img1, region))
+    memo, fingerprint = None, None
+    if config.score_memo:
+        # the last score of this template region, reused if pixels of img1 at region are unchanged
+        memo = ImageTemplates.region_data(img2, region, 'score_memo')
+        fingerprint = (m1.shape, zlib.crc32(numpy.ascontiguousarray(m1)))
+        last = memo.get(method)
+        if last is not None and last[0] == fingerprint:
+            return last[1]
+    m2 = template_data(img2, region, 'rgb')
+    resized = m1.shape != m2.shape
+    if resized:
+        if m1.shape[1] < m2.shape[1]:
+            m2 = cv2.resize(m2, (m1.shape[1], m1.shape[0]), interpolation=cv2.INTER_CUBIC)
+        else:
+            m1 = cv2.resize(m1, (m2.shape[1], m2.shape[0]), interpolation=cv2.INTER_CUBIC)
 
     # if img1.width < 30:
     #     method = 'hist'
-    if method is None:
-        method = config.sim_algo or 'ssim'
-    assert method in ('template', 'ssim', 'hist', 'hash'), method
     if method == 'template':
-        dx = min(4, img2.width * 0.2)
-        dy = min(4, img2.height * 0.2)
-        img2 = img2.crop((dx, dy, img2.width - dx, img2.height - dy))
-        sim = numpy.max(cv2.matchTemplate(pil_to_cv2(img1), pil_to_cv2(img2), cv2.TM_CCOEFF_NORMED))
-        # print(f'sim={sim:.4f}')
-        return sim
+        m2 = _template_inner(m2) if resized else template_data(img2, region, 'template')
+        # TM_CCOEFF_NORMED is independent of channel order, RGB arrays are used directly
+        sim = numpy.max(cv2.matchTemplate(m1, m2, cv2.TM_CCOEFF_NORMED))
     elif method == 'ssim':
-        try:
+        win_size = _ssim_win_size(*m1.shape[:2])
+        if win_size < 3:
+            # too small(like <3) for structural similarity, use hist method instead
+            sim = float(_hist_sim(_histogram(m1), _histogram(m2)))
+        else:
             # noinspection PyTypeChecker,PyUnusedLocal
-            sim = structural_similarity(numpy.array(img1), numpy.array(img2), multichannel=True)
-        except ValueError:
-            """When cropped image size is too small(like <7), it will raise
-            ValueError: win_size exceeds image extent.  If the input is a multichannel (color) image, 
-            set multichannel=True."""
-            logger.debug('skimage.metrics.structural_similarity failed. Use hist method instead.')
-            sim = cal_sim(img1, img2, method='hist')
+            sim = structural_similarity(m1, m2, win_size=win_size, channel_axis=-1, data_range=255)
+    elif method == 'ssim_fast':
+        stats = _ssim_stats(m2) if resized else template_data(img2, region, 'ssim_fast')
+        if stats is None:
+            sim = float(_hist_sim(_histogram(m1), _histogram(m2)))
+        else:
+            sim = _fast_ssim(m1, stats)
     elif method == 'hist':
-        size = tuple(numpy.min((img1.size, img2.size), 0))
-        if size != img1.size:
-            img1 = img1.resize(size)
-            img2 = img2.resize(size)
-        lh = img1.histogram()
-        rh = img2.histogram()
-        # remove unused color where _l=_r=0
-        diff = [1 - (0 if _l == _r else float(abs(_l - _r)) / max(_l, _r)) for _l, _r in zip(lh, rh) if _l + _r != 0]
-        sim = sum(diff) / len(diff)
+        lh = _histogram(m1)
+        rh = _histogram(m2) if resized else template_data(img2, region, 'hist')
+        sim = float(_hist_sim(lh, rh))
     elif method == 'hash':
-        # https://stackoverflow.com/questions/843972/image-comparison-fast-algorithm
-        img1 = img1.filter(ImageFilter.BoxBlur(radius=3))
-        img2 = img2.filter(ImageFilter.BoxBlur(radius=3))
-        phashvalue = imagehash.phash(img1) - imagehash.phash(img2)
-        ahashvalue = imagehash.average_hash(img1) - imagehash.average_hash(img2)
-        totalaccuracy = phashvalue + ahashvalue
-        sim = 1 - totalaccuracy / 100
+        lh = _image_hash(m1)
+        rh = _image_hash(m2) if resized else template_data(img2, region, 'hash')
+        sim = 1 - numpy.count_nonzero(lh != rh) / 100
     else:
         raise ValueError(f'invalid method "{method}", only "ssim" and "hist" supported')
     # print(f'sim={sim:.4f}')
+    if memo is not None:
+        memo[method] = (fingerprint, sim)
     return sim
 
 
+def _image_array(img: ImageLike) -> numpy.ndarray:
+    """Contiguous RGB array of PIL image or numpy array, only copied if needed"""
+    if isinstance(img, numpy.ndarray):
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = img[:, :, :3]
+        return numpy.ascontiguousarray(img)
+    if isinstance(img, LazyImage):
+        return ImageTemplates.region_data(img, None, 'rgb')
+    return numpy.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
+
+
+def _array_to_image(frame: numpy.ndarray, region: Sequence = None) -> Image.Image:
+    """PIL image of frame cropped at region, only the cropped part is converted if it's inside frame"""
+    if region is not None:
+        h, w = frame.shape[:2]
+        x0, y0, x1, y1 = [int(round(v)) for v in region]
+        if 0 <= x0 < x1 <= w and 0 <= y0 < y1 <= h:
+            return Image.fromarray(numpy.ascontiguousarray(frame[y0:y1, x0:x1]))
+    image = Image.fromarray(numpy.ascontiguousarray(frame))
+    return image if region is None else image.crop(region)
+
+
+def _template_inner(m: numpy.ndarray) -> numpy.ndarray:
+    """crop template slightly for `cal_sim(method='template')`"""
+    h, w = m.shape[:2]
+    dx, dy = int(round(min(4, w * 0.2))), int(round(min(4, h * 0.2)))
+    return numpy.ascontiguousarray(m[dy:h - dy, dx:w - dx])
+
+
+def _histogram(m: numpy.ndarray) -> numpy.ndarray:
+    """The same as `PIL.Image.histogram()` of RGB image: 256 bins for every channel."""
+    return numpy.concatenate([cv2.calcHist([m], [c], None, [256], [0, 256]).ravel() for c in range(3)]).astype(
+        numpy.float64)
+
+
+def _hist_sim(lh: numpy.ndarray, rh: numpy.ndarray) -> Union[float, numpy.ndarray]:
+    """
+    Mean of `1-|l-r|/max(l,r)` over bins used by either histogram.
+    `rh` could be stacked histograms (n,768), then return n similarities.
+    """
+    mx = numpy.maximum(lh, rh)
+    used = mx > 0  # remove unused color where _l=_r=0
+    diff = numpy.where(used, 1 - numpy.abs(lh - rh) / numpy.where(used, mx, 1), 0)
+    return diff.sum(-1) / used.sum(-1)
+
+
+def _ssim_win_size(h: int, w: int) -> int:
+    """odd window size of structural similarity, at most 7. Less than 3 means the image is too small"""
+    win_size = min(7, h, w)
+    return win_size if win_size % 2 == 1 else win_size - 1
+
+
+# crops are downscaled until the longer side <= _SSIM_MAX_SIDE for fast ssim
+_SSIM_MAX_SIDE = 64
+
+
+def _ssim_gray(m: numpy.ndarray) -> numpy.ndarray:
+    """grayscale float32 array of RGB array, downscaled by an integer factor decided by its size only"""
+    h, w = m.shape[:2]
+    factor = max(1, min(-(-max(h, w) // _SSIM_MAX_SIDE), min(h, w) // 7))
+    gray = cv2.cvtColor(m, cv2.COLOR_RGB2GRAY)
+    if factor > 1:
+        gray = cv2.resize(gray, (w // factor, h // factor), interpolation=cv2.INTER_AREA)
+    return gray.astype(numpy.float32)
+
+
+def _ssim_stats(m: numpy.ndarray):
+    """
+    Statistics of RGB array used by fast ssim: (gray, local mean, local variance, win_size).
+    Return None if image is too small.
+    """
+    gray = _ssim_gray(m)
+    win_size = _ssim_win_size(*gray.shape)
+    if win_size < 3:
+        return None
+    mu = cv2.blur(gray, (win_size, win_size))
+    var = cv2.blur(gray * gray, (win_size, win_size)) - mu * mu
+    return gray, mu, var, win_size
+
+
+def _fast_ssim(m: numpy.ndarray, stats) -> float:
+    """
+    Mean structural similarity between RGB array `m` and the template whose statistics is `stats`,
+    the same formula as `skimage.metrics.structural_similarity` with uniform window and sample covariance.
+    """
+    gray_x, mu_x, var_x, win_size = stats
+    gray_y = _ssim_gray(m)
+    ksize = (win_size, win_size)
+    mu_y = cv2.blur(gray_y, ksize)
+    var_y = cv2.blur(gray_y * gray_y, ksize) - mu_y * mu_y
+    cov = cv2.blur(gray_x * gray_y, ksize) - mu_x * mu_y
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    s = ((2 * mu_x * mu_y + c1) * (2 * cov_norm * cov + c2)) / \
+        ((mu_x * mu_x + mu_y * mu_y + c1) * (cov_norm * (var_x + var_y) + c2))
+    # ignore the border affected by padding
+    pad = (win_size - 1) // 2
+    return float(numpy.mean(s[pad:s.shape[0] - pad, pad:s.shape[1] - pad], dtype=numpy.float64))
+
+
+def cal_hist_sims(img: ImageLike, targets: Sequence[ImageLike], region: Sequence = None) -> numpy.ndarray:
+    """
+    Histogram similarities(see `cal_sim(method='hist')`) of `img` against every target at the same region,
+    cached histograms of targets are compared in one vectorized call.
+
+    :return: array of similarities, same order as targets
+    """
+    m1 = _image_array(crop(img, region))
+    lh = _histogram(m1)
+    sims = numpy.empty(len(targets))
+    stacked, indices = [], []
+    for i, target in enumerate(targets):
+        if template_data(target, region, 'rgb').shape == m1.shape:
+            stacked.append(template_data(target, region, 'hist'))
+            indices.append(i)
+        else:
+            # resize needed, fallback to compare one by one
+            sims[i] = cal_sim(img, target, region, 'hist')
+    if stacked:
+        sims[indices] = _hist_sim(lh, numpy.stack(stacked))
+    return sims
+
+
+def _image_hash(m: numpy.ndarray) -> numpy.ndarray:
+    """bits of phash and average hash(128 bools) of blurred RGB array"""
+    # https://stackoverflow.com/questions/843972/image-comparison-fast-algorithm
+    img = Image.fromarray(m).filter(ImageFilter.BoxBlur(radius=3))
+    return numpy.concatenate([imagehash.phash(img).hash.ravel(), imagehash.average_hash(img).hash.ravel()])
+
+
+def hash_distances(img: ImageLike, targets: Sequence[ImageLike], region: Sequence = None) -> numpy.ndarray:
+    """
+    Hamming distances(0~128) of image hash between `img` and every target at the same region,
+    computed in bulk over the cached hashes of targets. See 'hash' method of `cal_sim`.
+    """
+    m = _image_array(crop(img, region))
+    lh = _image_hash(m)
+    if len(targets) == 0:
+        return numpy.zeros(0, dtype=int)
+    rh = numpy.stack([template_data(target, region, 'hash') for target in targets])
+    return numpy.count_nonzero(rh != lh, axis=1)
+
+
+ImageTemplates.register_region_kind('gray', lambda m: cv2.cvtColor(m, cv2.COLOR_RGB2GRAY))
+ImageTemplates.register_region_kind('template', _template_inner)
+ImageTemplates.register_region_kind('hist', _histogram)
+ImageTemplates.register_region_kind('ssim_fast', _ssim_stats)
+ImageTemplates.register_region_kind('hash', _image_hash)
+# {method: (fingerprint of the compared region, score)}, see `cal_sim`
+ImageTemplates.register_region_kind('score_memo', lambda m: {})
+
+
 def compress_image(image: Image.Image, scale=1, _format='jpeg', quality=-1, output: str = 'buffer'):
     """
     Compress image to io buffer(output='buffer') or a new Image object(output='pil').
@@ -114,9 +310,9 @@ def compress_image(image: Image.Image, scale=1, _format='jpeg', quality=-1, outp
 
 
 # %% automatic
-def _fix_length(images: Union[Image.Image, Sequence[Image.Image]], regions: Sequence):
+def _fix_length(images: Union[ImageLike, Sequence[ImageLike]], regions: Sequence):
     # fix to equal length of images and regions
-    if isinstance(images, Image.Image):
+    if isinstance(images, (Image.Image, LazyImage, numpy.ndarray)):
         images = [images]
     # if images is None:
     #     images = [None]
@@ -137,63 +333,330 @@ def _fix_length(images: Union[Image.Image, Sequence[Image.Image]], regions: Sequ
     return images, regions
 
 
-def screenshot(region: Sequence = None, filepath: str = None, monitor: int = None) -> Image.Image:
+class ScreenGrabber(threading.local):
+    """
+    Long-lived mss grabber, created once per thread since mss handles cannot be shared between threads.
+    Only the requested region inside monitor is grabbed rather than the full monitor.
     """
-    Take screenshot of multi-monitors.
 
-    :param region: region inside monitor
-    :param filepath: if not None, save to `filepath` then return Image
-    :param monitor: 0-total size of all monitors, >0: monitor N, shown in system settings
-    :return: PIL.Image.Image
-    """
-    with _screenshot_locker:
-        if monitor is None:
-            monitor = config.monitor
-        _image = None
-        size = (1920, 1080)  # default size
-        if config.is_wda:
+    def __init__(self):
+        self._sct = None
+
+    @property
+    def sct(self):
+        if self._sct is None:
+            self._sct = mss()
+        return self._sct
+
+    def grab(self, monitor: int, region: Sequence = None):
+        """
+        Grab region of monitor.
+
+        :param monitor: see `screenshot`
+        :param region: region inside monitor. If it exceeds the monitor, the full monitor is grabbed.
+        :return: (mss ScreenShot, region still to crop or None)
+        """
+        mon: dict = self.sct.monitors[monitor]
+        if region is None:
+            return self.sct.grab(mon), None
+        x0, y0, x1, y1 = [int(round(v)) for v in region]
+        if 0 <= x0 < x1 <= mon['width'] and 0 <= y0 < y1 <= mon['height']:
+            area = {'left': mon['left'] + x0, 'top': mon['top'] + y0, 'width': x1 - x0, 'height': y1 - y0}
+            return self.sct.grab(area), None
+        # PIL pads the outside part, keep the same behavior
+        return self.sct.grab(mon), region
+
+    def close(self):
+        """Release grabber of current thread, a new one is created at next grab(e.g. after monitor changed)"""
+        if self._sct is not None:
+            try:
+                self._sct.close()
+            finally:
+                self._sct = None
+
+
+_grabber = ScreenGrabber()
+
+
+class FrameCache:
+    """
+    Latest full frame(read-only RGB array) of every monitor, shared by all callers(and threads)
+    within `max_age` seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frames: Dict[int, Tuple[float, numpy.ndarray]] = {}
+
+    def get(self, monitor: int, max_age: float) -> Optional[numpy.ndarray]:
+        with self._lock:
+            item = self._frames.get(monitor)
+        if item is not None and time.time() - item[0] <= max_age:
+            return item[1]
+        return None
+
+    def put(self, monitor: int, frame: numpy.ndarray, t: float = None):
+        with self._lock:
+            self._frames[monitor] = (time.time() if t is None else t, frame)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+
+_frame_cache = FrameCache()
+
+
+def _shot_array(shot) -> numpy.ndarray:
+    """Read-only RGB view of mss BGRA screenshot without copy"""
+    frame = numpy.frombuffer(shot.raw, numpy.uint8).reshape(shot.height, shot.width, 4)[:, :, 2::-1]
+    frame.setflags(write=False)
+    return frame
+
+
+def _grab_frame(monitor: int, region: Sequence = None) -> Tuple[Optional[numpy.ndarray], Optional[Sequence]]:
+    """
+    :return: (frame, region still to crop), frame is None if grab failed
+    """
+    t0 = time.time()
+    if config.is_wda:
+        with _screenshot_locker:
             try:
-                _image = config.wda_client.screenshot().convert('RGB')
-                size = _image.size
+                frame = numpy.asarray(config.wda_client.screenshot().convert('RGB'))
+                _frame_cache.put(monitor, frame, t0)
+                return frame, region
             except Exception as e:
                 logger.error(f'Fail to grab screenshot WDA. Error:\n{e}')
-        else:
-            with mss() as sct:
+    else:
+        try:
+            shot, crop_region = _grabber.grab(monitor, region)
+            frame = _shot_array(shot)
+            if region is None:
+                _frame_cache.put(monitor, frame, t0)
+            return frame, crop_region
+        except Exception as e:
+            logger.error(f'Fail to grab screenshot using mss(). Error:\n{e}')
+            # monitors may be changed, re-create grabber next time
+            _grabber.close()
+            if tuple(config.offset) == (0, 0):
+                # ImageGrab can only grab the main screen
                 try:
-                    mon = dict(sct.monitors[monitor])  # copy
-                    # mon['width'], mon['height'] = size[0], size[1]  # introduce by dpi issue, force set screen size
-                    shot = sct.grab(mon)
-                    size = shot.size
-                    # import pprint
-                    # pprint.pprint(sct._monitors)
-                    _image = Image.frombytes('RGB', size, shot.bgra, 'raw', 'BGRX').crop(region)
+                    return numpy.asarray(ImageGrab.grab().convert('RGB')), region
                 except Exception as e:
-                    logger.error(f'Fail to grab screenshot using mss(). Error:\n{e}')
-                    if tuple(config.offset) == (0, 0):
-                        # ImageGrab can only grab the main screen
-                        try:
-                            _image = ImageGrab.grab()
-                        except Exception as e:
-                            logger.error(f'Fail to grab screenshot using ImageGrad. Error:\n{e}')
-        if _image is None:
-            # grab failed, return an empty image with single color
-            # wait for a moment for grabbing next screenshot
-            _image = Image.new('RGB', size, (0, 255, 255)).crop(region)
-            time.sleep(5)
-        else:
-            if filepath is not None:
-                _image.save(filepath)
-        return _image
+                    logger.error(f'Fail to grab screenshot using ImageGrad. Error:\n{e}')
+    return None, region
+
+
+def screenshot(region: Sequence = None, filepath: str = None, monitor: int = None, fresh=False, as_array=False):
+    # type:(Sequence,str,int,bool,bool)->ImageLike
+    """
+    Take screenshot of multi-monitors.
+
+    Full frames are cached for `config.frame_cache_age` seconds, so that several matchers in one poll
+    share one capture.
+
+    :param region: region inside monitor
+    :param filepath: if not None, save to `filepath` then return Image
+    :param monitor: 0-total size of all monitors, >0: monitor N, shown in system settings
+    :param fresh: if True, bypass the frame cache and grab a new frame
+    :param as_array: if True, return read-only RGB numpy array(h,w,3) instead of PIL Image. The array may be a view
+            of the captured frame, no conversion or copy is made, prefer it for image matching.
+    :return: PIL.Image.Image or numpy.ndarray
+    """
+    if monitor is None:
+        monitor = config.monitor
+    max_age = 0 if fresh else config.frame_cache_age
+    frame = _frame_cache.get(monitor, max_age) if max_age > 0 else None
+    crop_region = region
+    if frame is None:
+        frame, crop_region = _grab_frame(monitor, region)
+    failed = frame is None
+    if failed:
+        # grab failed, return an empty image with single color
+        # wait for a moment for grabbing next screenshot
+        frame = numpy.full((1080, 1920, 3), (0, 255, 255), numpy.uint8)
+        time.sleep(5)
+    if as_array:
+        _image = crop(frame, crop_region)
+    else:
+        _image = _array_to_image(frame, crop_region)
+    if filepath is not None and not failed:
+        (_array_to_image(frame, crop_region) if as_array else _image).save(filepath)
+    return _image
+
+
+class ImageWriter:
+    """
+    Save images in a background thread, so that image encoding and disk writing don't block the caller.
+
+    The queue is bounded: `put` blocks while `max_pending` images are waiting(backpressure), memory won't grow
+    if the disk is slower than images produced. Pending images are flushed at exit.
+    """
+
+    def __init__(self, max_pending=8):
+        self.queue = queue.Queue(max(1, max_pending))
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def save_params(fmt: str, compress_level: int = None) -> Dict[str, Any]:
+        """
+        :param fmt: 'png' or 'webp'(lossless).
+        :param compress_level: png: 0~9, webp: 0~6(method), higher is smaller but slower.
+        :return: params of `Image.save`
+        """
+        fmt = fmt.lower()
+        if fmt == 'png':
+            return {'format': 'PNG', 'compress_level': 6 if compress_level is None else compress_level}
+        elif fmt == 'webp':
+            return {'format': 'WEBP', 'lossless': True, 'method': 4 if compress_level is None else compress_level}
+        raise ValueError(f'unsupported image format "{fmt}", only "png" and "webp" supported')
+
+    def put(self, image: ImageLike, fp: str, region: Sequence = None, **params):
+        """
+        :param image: PIL image or RGB array, arrays are copied since frames may be shared.
+        :param fp: filepath, parent folder is created if not exists.
+        :param region: crop image at region before saving.
+        :param params: params of `Image.save`, see `save_params`.
+        """
+        if isinstance(image, numpy.ndarray):
+            # only the cropped part is copied if region is inside the frame
+            if region is not None:
+                h, w = image.shape[:2]
+                x0, y0, x1, y1 = [int(round(v)) for v in region]
+                if 0 <= x0 < x1 <= w and 0 <= y0 < y1 <= h:
+                    image, region = image[y0:y1, x0:x1], None
+            image = numpy.array(image)
+        self._start()
+        self.queue.put((image, fp, region, params))
+
+    def flush(self, timeout: float = None) -> bool:
+        """wait until all pending images saved, :return: False if timeout"""
+        end_time = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if end_time is None else end_time - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='image-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            image, fp, region, params = self.queue.get()
+            try:
+                if isinstance(image, numpy.ndarray):
+                    image = _array_to_image(image, region)
+                elif region is not None:
+                    image = image.crop(region)
+                folder = os.path.dirname(fp)
+                if folder and not os.path.exists(folder):
+                    os.makedirs(folder, exist_ok=True)
+                image.save(fp, **params)
+            except Exception as e:  # noqa
+                logger.error(f'failed to save image "{fp}": {e}')
+            finally:
+                self.queue.task_done()
+
+
+def get_image_writer() -> ImageWriter:
+    global _image_writer
+    if _image_writer is None:
+        _image_writer = ImageWriter(config.image_writer_queue)
+        atexit.register(_image_writer.flush, 10)
+    return _image_writer
 
 
-def match_one_target(img: Image.Image, target: Image.Image, region: Sequence, threshold: float = None) -> bool:
+def detect_screen_box(frame: numpy.ndarray = None, ratio=16 / 9, threshold=4.0, min_edge=8.0):
+    # type:(numpy.ndarray,float,float,float)->Optional[Tuple[int,int,int,int]]
+    """
+    Detect the game render box(left, top, right, bottom) inside the captured frame.
+
+    Emulator borders and letterbox bars are trimmed first: rows/columns at the edges whose pixels are nearly uniform.
+    Then the box of `ratio` is fitted, the left and bottom sides are kept, while title bar at the top and
+    toolbar at the right side may remain: among all possible tops(and the right side decided by ratio),
+    the one whose top and right boundaries are both the strongest straight edges is chosen.
+    Trimmed rows at the top may be dark contents of game rather than border, so if the box fitted to the width of
+    contents reaches into them, that top is a candidate too.
+
+    :param frame: RGB array, default take a new full screenshot.
+    :param threshold: rows/columns whose std of gray value <= threshold are treated as border.
+    :param min_edge: min mean gradient across the top and right boundaries, weaker boxes are rejected.
+    :return: box, or None if nothing like a game screen is found(e.g. black loading page).
+    """
+    if frame is None:
+        frame = screenshot(fresh=True, as_array=True)
+    gray = cv2.cvtColor(numpy.ascontiguousarray(frame), cv2.COLOR_RGB2GRAY).astype(numpy.float32)
+    rows = numpy.flatnonzero(gray.std(1) > threshold)
+    cols = numpy.flatnonzero(gray.std(0) > threshold)
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    x0, x1, y0, y1 = int(cols[0]), int(cols[-1]) + 1, int(rows[0]), int(rows[-1]) + 1
+    height, width = gray.shape
+
+    def _edge(top, right):
+        # mean gradient across the top and right boundaries, boundaries of frame are treated as strongest.
+        # both must be edges, the weaker one is the score
+        top_edge = 255 if top == 0 else numpy.mean(numpy.abs(gray[top, x0:right] - gray[top - 1, x0:right]))
+        right_edge = 255 if right == width else numpy.mean(numpy.abs(gray[top:y1, right] - gray[top:y1, right - 1]))
+        return min(top_edge, right_edge)
+
+    best = None
+    for y in range(max(0, y1 - int((width - x0) / ratio)), y0 + (y1 - y0) // 4 + 1):
+        x = x0 + int(round((y1 - y) * ratio))
+        # tops above contents only if the width of contents requires it
+        if x > width or y < y0 and abs(x - x1) > 1:
+            continue
+        score = _edge(y, x)
+        if best is None or score > best[0]:
+            best = (score, y, x)
+    if best is None or best[0] < min_edge or best[2] - x0 < 320:
+        return None
+    return x0, best[1], best[2], y1
+
+
+def auto_relocate(LOC: Regions, frame: numpy.ndarray = None, confirm=3, interval=0.5) -> bool:
+    """
+    Detect screen box and relocate `LOC` into it if changed, e.g. emulator window moved or resized.
+    Loading or fading pages may be misdetected, so the new box must be detected in `confirm` consecutive frames.
+    Relocated layouts are cached and swapped in at once, see `Regions.relocate`.
+
+    :param frame: the first frame to detect, following frames are taken every `interval` seconds.
+    :return: relocated or not.
+    """
+    box = None
+    for i in range(max(1, confirm)):
+        if i > 0:
+            time.sleep(interval)
+            frame = None
+        detected = detect_screen_box(frame)
+        if detected is None:
+            logger.warning('screen box not detected, regions are not relocated')
+            return False
+        if detected == tuple(LOC.box):
+            return False
+        if box is not None and detected != box:
+            logger.warning(f'screen box is unstable: {box} -> {detected}, regions are not relocated')
+            return False
+        box = detected
+    LOC.relocate(box)
+    return True
+
+
+def match_one_target(img: ImageLike, target: ImageLike, region: Sequence, threshold: float = None) -> bool:
     if threshold is None:
         threshold = THR
     return cal_sim(img, target, region) >= threshold
 
 
 def match_targets(img, targets, regions=None, threshold=None, at=None, lapse=0.0):
-    # type:(Image.Image,Union[Image.Image,Sequence[Image.Image]],Sequence,float,Union[int,Sequence],float)->bool
+    # type:(ImageLike,Union[ImageLike,Sequence[ImageLike]],Sequence,float,Union[int,Sequence],float)->bool
     """
     Match all targets. See `wait_targets`.
     `at` is a region or an **int** value of target index.
@@ -218,13 +681,87 @@ def match_targets(img, targets, regions=None, threshold=None, at=None, lapse=0.0
     return True
 
 
+class MatchScores:
+    """
+    Similarities of one image against several (target, region) pairs, see `match_scores`.
+    Skipped targets(None) and targets rejected by hash prefilter have score -inf.
+    """
+
+    def __init__(self, scores: Sequence[float]):
+        self.scores = numpy.asarray(scores, dtype=numpy.float64)
+        valid = numpy.flatnonzero(numpy.isfinite(self.scores))
+        ranked = valid[numpy.argsort(self.scores[valid])[::-1]]
+        # index and score of the best matched target, -1 if no valid target
+        self.best = int(ranked[0]) if len(ranked) > 0 else -1
+        self.best_score = float(self.scores[self.best]) if self.best >= 0 else -numpy.inf
+        # margin of best score over the runner-up, inf if only one valid target
+        self.margin = self.best_score - float(self.scores[ranked[1]]) if len(ranked) > 1 else numpy.inf
+
+    def first(self, threshold: float) -> int:
+        """index of the first target whose score >= threshold, -1 if not matched"""
+        matched = numpy.flatnonzero(self.scores >= threshold)
+        return int(matched[0]) if len(matched) > 0 else -1
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(scores={numpy.round(self.scores, 4).tolist()}, ' \
+               f'best={self.best}, margin={self.margin:.4f})'
+
+
+def get_match_executor() -> ThreadPoolExecutor:
+    global _match_executor
+    if _match_executor is None:
+        _match_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='match')
+    return _match_executor
+
+
+def match_scores(img, targets, regions=None, method=None, parallel=False, prefilter=None):
+    # type:(ImageLike,Union[ImageLike,Sequence[ImageLike]],Sequence,str,bool,int)->MatchScores
+    """
+    Compute similarities of `img` against all (target, region) pairs at once, see `cal_sim`.
+    Lengths of targets and regions follow `_fix_length`, target of None is skipped.
+
+    :param parallel: if True, run comparisons on a shared thread pool since cv2/skimage release the GIL.
+    :param prefilter: max hamming distance of image hash(see `hash_distances`), targets beyond it are rejected
+                      before the expensive comparison. Default `config.hash_prefilter`, None to disable.
+    :return: MatchScores, contains every score, the best match and its margin over the runner-up.
+    """
+    targets, regions = _fix_length(targets, regions)
+    scores = numpy.full(len(targets), -numpy.inf)
+    pairs = [i for i, target in enumerate(targets) if target is not None]
+    method = method or config.sim_algo
+    if prefilter is None:
+        prefilter = config.hash_prefilter
+    # targets sharing the same region are compared in one vectorized call
+    groups: Dict[Any, List[int]] = {}
+    for i in pairs:
+        groups.setdefault(None if regions[i] is None else tuple(regions[i]), []).append(i)
+    if prefilter is not None and method != 'hash' and len(pairs) > 1:
+        pairs = []
+        for region, indices in groups.items():
+            distances = hash_distances(img, [targets[i] for i in indices], region)
+            indices[:] = [i for i, d in zip(indices, distances) if d <= prefilter]
+            pairs.extend(indices)
+        pairs.sort()
+    if method == 'hist':
+        for region, indices in groups.items():
+            if indices:
+                scores[indices] = cal_hist_sims(img, [targets[i] for i in indices], region)
+    elif parallel and len(pairs) > 1:
+        futures = [get_match_executor().submit(cal_sim, img, targets[i], regions[i], method) for i in pairs]
+        scores[pairs] = [future.result() for future in futures]
+    else:
+        scores[pairs] = [cal_sim(img, targets[i], regions[i], method) for i in pairs]
+    return MatchScores(scores)
+
+
 # 匹配第几个target
 def match_which_target(img, targets, regions=None, threshold=None, at=None, lapse=0.0):
-    # type:(Image.Image,Union[Image.Image,Sequence[Image.Image]],Sequence,float,Union[bool,Sequence],float)->int
+    # type:(ImageLike,Union[ImageLike,Sequence[ImageLike]],Sequence,float,Union[bool,Sequence],float)->int
     """
     Compare targets to find which matches. See `wait_which_target`.
     `at` is a region or **bool** value `True`, if True, click matched region.
-    if target in `targets` is None, it will be skipped matching
+    if target in `targets` is None, it will be skipped matching.
+    All targets are compared in parallel, see `match_scores`.
 
     :return: matched index, return -1 if not matched.
     """
@@ -232,20 +769,74 @@ def match_which_target(img, targets, regions=None, threshold=None, at=None, laps
         threshold = THR
     targets, regions = _fix_length(targets, regions)
     assert len(targets) > 1, f'length of targets or regions must be at least 2: {(len(targets), len(regions))}'
-    res = -1
-    for target, region in zip(targets, regions):
-        res += 1
-        if target is not None and cal_sim(img, target, region) >= threshold:
-            if at is None:
-                pass
-            elif isinstance(at, Sequence):
-                click(at, lapse)
-            elif at is True:
-                click(regions[res], lapse)
-            else:
-                assert False, f'*at* should be True or a region: at={at}'
-            return res
-    return -1
+    res = match_scores(img, targets, regions, parallel=True).first(threshold)
+    if res >= 0:
+        if at is None:
+            pass
+        elif isinstance(at, Sequence):
+            click(at, lapse)
+        elif at is True:
+            click(regions[res], lapse)
+        else:
+            assert False, f'*at* should be True or a region: at={at}'
+    return res
+
+
+class FramePoller:
+    """
+    Screenshot poller of waiting loops, driven by frame changes rather than a fixed interval.
+
+    A frame is returned only if the watched regions changed since the last returned frame, or `refresh` secs passed.
+    Polling interval is reset to `min_interval` once the screen changes, and doubled up to `max_interval`
+    while the screen keeps static, so matchers are not re-run on the same screen.
+    """
+
+    def __init__(self, regions: Sequence = None, max_interval=0.2, min_interval: float = None, refresh=2.0,
+                 box: Sequence = None):
+        """
+        :param regions: one region or list of regions to watch, None to watch the whole frame.
+        :param max_interval: max interval when screen is static, usually the `interval` of waiting functions.
+        :param min_interval: interval when screen is changing, default `config.poll_min_interval`.
+        :param refresh: max secs to return an unchanged frame, e.g. to click again.
+        :param box: screenshot region, see `screenshot`. Regions are relative to it.
+        """
+        if regions is not None and isinstance(regions[0], (int, float)):
+            regions = [regions]
+        self.regions = regions
+        self.max_interval = max_interval
+        if min_interval is None:
+            min_interval = min(config.poll_min_interval, max_interval)
+        self.min_interval = min_interval
+        self.refresh = refresh
+        self.box = box
+        self.interval = min_interval
+        self._fingerprint = None
+        self._last_time = 0.0
+        self._polled = False
+
+    def fingerprint(self, frame: numpy.ndarray) -> int:
+        if self.regions is None:
+            # subsampled, enough to detect transitions and animations
+            return zlib.crc32(numpy.ascontiguousarray(frame[::4, ::4]))
+        value = 0
+        for region in self.regions:
+            value = zlib.crc32(numpy.ascontiguousarray(crop(frame, region)), value)
+        return value
+
+    def next(self) -> numpy.ndarray:
+        """wait and return the next changed frame, the first call returns immediately"""
+        while True:
+            if self._polled:
+                sleep(self.interval)
+            self._polled = True
+            frame = screenshot(self.box, as_array=True)
+            fingerprint = self.fingerprint(frame)
+            now = time.time()
+            changed = fingerprint != self._fingerprint
+            self.interval = self.min_interval if changed else min(self.interval * 2, self.max_interval)
+            if changed or now - self._last_time >= self.refresh:
+                self._fingerprint, self._last_time = fingerprint, now
+                return frame
 
 
 def wait_targets(targets, regions, threshold=None, at=None, lapse=0.0, clicking=None, interval=0.2):
@@ -256,14 +847,15 @@ def wait_targets(targets, regions, threshold=None, at=None, lapse=0.0, clicking=
     :param : See `wait_which_target`
     :return: None
     """
-    n = 0
+    poller = FramePoller(_fix_length(targets, regions)[1], interval, refresh=interval if clicking is not None else 2.0)
+    clicked_time = 0.0
     while True:
-        n += 1
-        if match_targets(screenshot(), targets, regions, threshold, at, lapse):
+        if match_targets(poller.next(), targets, regions, threshold, at, lapse):
             return
-        if clicking is not None:
+        # frames change fast during animations, click at the cadence of interval rather than of polling
+        if clicking is not None and time.time() - clicked_time >= interval:
+            clicked_time = time.time()
             click(clicking, 0)
-        sleep(interval)
 
 
 # 直到匹配某一个target
@@ -280,23 +872,28 @@ def wait_which_target(targets, regions, threshold=None, at=None, lapse=0.0, clic
     :param at:  if True, click the region which target matches,
             if a region, click the region.
     :param lapse: lapse when click `at`.
-    :param clicking: a region to click at until screenshot matches some target.
+    :param clicking: a region to click at until screenshot matches some target, at most once every `interval`.
             e.g. Arash death animation, kizuna->rewards page.
-    :param interval: interval of loop when no one matched.
+    :param interval: max interval of loop when no one matched, matching is re-run once screen changes,
+            see `FramePoller`.
     :return: the index which target matches.
     """
+    poller = FramePoller(_fix_length(targets, regions)[1], interval, refresh=interval if clicking is not None else 2.0)
+    clicked_time = 0.0
     while True:
-        res = match_which_target(screenshot(), targets, regions, threshold, at, lapse)
+        res = match_which_target(poller.next(), targets, regions, threshold, at, lapse)
         if res >= 0:
             return res
-        if clicking is not None:
+        # frames change fast during animations, click at the cadence of interval rather than of polling
+        if clicking is not None and time.time() - clicked_time >= interval:
+            clicked_time = time.time()
             for _ in range(3):
                 click(clicking, 0)
-        sleep(interval)
 
 
 # 直到匹配模板
-def wait_search_template(target: Image.Image, search_box=None, threshold: float = None, lapse=0.0, interval=0.2):
+def wait_search_template(target: Image.Image, search_box=None, threshold: float = None, lapse=0.0, interval=0.2,
+                         target_region=None):
     """
 
     :param target: only target template, not full screenshot
@@ -304,20 +901,21 @@ def wait_search_template(target: Image.Image, search_box=None, threshold: float
     :param threshold:
     :param lapse:
     :param interval:
+    :param target_region: if not None, crop target at this region(cached), see `search_target`
     :return:
     """
     if threshold is None:
         threshold = THR
+    poller = FramePoller(max_interval=interval, box=search_box)
     while True:
-        if search_target(screenshot(search_box), target)[0] >= threshold:
+        if search_target(poller.next(), target, target_region=target_region)[0] >= threshold:
             time.sleep(lapse)
             return
-        sleep(interval)
 
 
 # 搜索目标模板存在匹配的最大值
 # noinspection PyTypeChecker
-def search_target(img: Image.Image, target: Image.Image, mode='cv2'):
+def search_target(img: ImageLike, target: ImageLike, mode='cv2', target_region: Sequence = None):
     """
     find the max matched target in img.
 
@@ -325,34 +923,104 @@ def search_target(img: Image.Image, target: Image.Image, mode='cv2'):
     :param target:
     :param mode: 'cv2'(default) to use open-cv(quick), 'sk' to use skimage package(VERY slow)
             Attention: cv2 use (h,w), but PIL/numpy use (w,h).
+    :param target_region: if not None, crop target at this region. Prefer it rather than `target.crop(region)`,
+            since the cropped array is cached, see `ImageTemplates.region_data`.
     :return (max value, left-top pos)
     """
+    m1: numpy.ndarray = _image_array(img)
+    m2: numpy.ndarray = template_data(target, target_region, 'rgb')
     # when scaling/relocate Regions, rect may have +-2 error range
-    if img.width < target.width:
-        target = target.crop((0, 0, img.width, target.height))
-    if img.height < target.height:
-        target = target.crop((0, 0, target.width, img.height))
-    m1: numpy.ndarray = numpy.array(img.convert('RGB'))
-    m2: numpy.ndarray = numpy.array(target.convert('RGB'))
+    if m1.shape[1] < m2.shape[1] or m1.shape[0] < m2.shape[0]:
+        m2 = numpy.ascontiguousarray(m2[:m1.shape[0], :m1.shape[1]])
     if mode == 'sk':
         matches: numpy.ndarray = sk_match_template(m1, m2)
         max_match = numpy.max(matches)
         pos = numpy.where(matches == max_match)
         return numpy.max(matches), (pos[1][0], pos[0][0])
     else:
-        cv_img = cv2.cvtColor(m1, cv2.COLOR_RGB2BGR)
-        cv_target = cv2.cvtColor(m2, cv2.COLOR_RGB2BGR)
-        # h, w = cv_target.shape[0:2]
-        matches = cv2.matchTemplate(cv_img, cv_target, cv2.TM_CCOEFF_NORMED)
+        # TM_CCOEFF_NORMED is independent of channel order, no need to convert RGB to BGR
+        # h, w = m2.shape[0:2]
+        matches = cv2.matchTemplate(m1, m2, cv2.TM_CCOEFF_NORMED)
         max_match = numpy.max(matches)
         pos = numpy.where(matches == max_match)
         # in PIL system, (x~w,y~h)
         return numpy.max(matches), (pos[1][0], pos[0][0])
 
 
+class TemplateAtlas:
+    """
+    Templates of the same size stacked into one array, so that a strip image is searched against all of them
+    in one vectorized pass rather than one `search_target` per template.
+
+    Score is the same as cv2.TM_CCOEFF_NORMED of `search_target`. Templates are slid vertically only:
+    the correlation along y is computed by FFT and summed over all columns in frequency domain,
+    so it fits strips slightly wider(few pixels) than templates, e.g. card slots.
+    """
+
+    def __init__(self, templates: Sequence[ImageLike]):
+        self.templates = list(templates)
+        arrays = [ImageTemplates.region_data(t, None, 'rgb') for t in self.templates]
+        assert len(arrays) > 0 and len(set(m.shape for m in arrays)) == 1, 'templates must have the same size'
+        self.shape = arrays[0].shape
+        h, w, c = self.shape
+        stacked = numpy.stack(arrays).astype(numpy.float64)
+        # zero mean per channel as TM_CCOEFF
+        stacked -= stacked.mean(axis=(1, 2), keepdims=True)
+        self._templates = stacked.reshape(len(arrays), h, w * c)
+        self._norms = numpy.sqrt(numpy.sum(self._templates ** 2, axis=(1, 2)))
+        # spectrum of templates for every FFT length: {length: (length//2+1, n, w*c)}, complex64 to save memory
+        self._spectrums: Dict[int, numpy.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def _spectrum(self, length: int) -> numpy.ndarray:
+        with self._lock:
+            spectrum = self._spectrums.get(length)
+            if spectrum is None:
+                spectrum = numpy.conj(numpy.fft.rfft(self._templates, length, axis=1)).astype(numpy.complex64)
+                spectrum = self._spectrums[length] = numpy.ascontiguousarray(spectrum.transpose(1, 0, 2))
+            return spectrum
+
+    def scores(self, img: ImageLike) -> numpy.ndarray:
+        """
+        :param img: strip, usually not smaller than templates.
+        :return: score matrix (templates, positions), positions are y offsets(top) of templates in img.
+            If img is wider than templates, the best horizontal offset is taken.
+            If img is smaller(e.g. relocated regions with +-2 error), fall back to `search_target`, only 1 position.
+        """
+        m = _image_array(img).astype(numpy.float64)
+        h, w, c = self.shape
+        height, width = m.shape[:2]
+        if height < h or width < w:
+            return numpy.array([[search_target(img, t)[0]] for t in self.templates], dtype=numpy.float64)
+        length = cv2.getOptimalDFTSize(height)
+        spectrum = self._spectrum(length)
+        n = height - h + 1
+        best = None
+        for dx in range(width - w + 1):
+            strip = m[:, dx:dx + w]
+            # numerator: correlation along y, summed over all columns and channels
+            image_spectrum = numpy.fft.rfft(strip.reshape(height, w * c), length, axis=0).astype(numpy.complex64)
+            # (f,k,wc)@(f,wc,1): sum over columns of every frequency in one batched matmul
+            products = numpy.matmul(spectrum, image_spectrum[:, :, None])[:, :, 0]
+            corr = numpy.fft.irfft(products.T, length, axis=1)[:, :n]
+            # denominator: zero-mean norm of every window by cumulative sums of rows
+            rows = numpy.concatenate([numpy.zeros((1, c + 1)),
+                                      numpy.cumsum(numpy.concatenate([strip.sum(1), (strip ** 2).sum((1, 2))[:, None]],
+                                                                     1), 0)])
+            window = rows[h:h + n] - rows[:n]
+            var = window[:, c] - numpy.sum(window[:, :c] ** 2, 1) / (h * w)
+            denominator = self._norms[:, None] * numpy.sqrt(numpy.maximum(var, 0))[None, :]
+            score = numpy.clip(numpy.where(denominator > 1e-6, corr / numpy.maximum(denominator, 1e-6), 0), -1, 1)
+            best = score if best is None else numpy.maximum(best, score)
+        return best
+
+
 # noinspection PyTypeChecker
-def search_peaks(image: Image.Image, target: Image.Image, column=True, threshold: float = None,
-                 **kwargs) -> numpy.ndarray:
+def search_peaks(image: ImageLike, target: ImageLike, column=True, threshold: float = None,
+                 target_region: Sequence = None, **kwargs) -> numpy.ndarray:
     """
     Find target position in img which contains several targets. For simplicity, `target` and `image` should have
     the same width or height. Thus it's 1-D search.
@@ -361,19 +1029,19 @@ def search_peaks(image: Image.Image, target: Image.Image, column=True, threshold
     :param target:
     :param column: search target in column or in row direction.
     :param threshold:
+    :param target_region: if not None, crop target at this region(cached), see `search_target`
     :param kwargs: extra args for `scipy.signal.find_peaks`
     :return: offsets of peaks in column/row direction.
     """
     if threshold is None:
         threshold = THR
+    m1: numpy.ndarray = _image_array(image)
+    m2: numpy.ndarray = template_data(target, target_region, 'rgb')
     if column is True:
-        assert image.size[0] == target.size[0], f'must be same width: img {image.size}, target {target.size}.'
+        assert m1.shape[1] == m2.shape[1], f'must be same width: img {m1.shape}, target {m2.shape}.'
     else:
-        assert image.size[1] == target.size[1], f'must be same height: img {image.size}, target {target.size}.'
-    m1: numpy.ndarray = numpy.array(image.convert('RGB'))
-    m2: numpy.ndarray = numpy.array(target.convert('RGB'))
-    cv_img, cv_target = (cv2.cvtColor(m1, cv2.COLOR_RGB2BGR), cv2.cvtColor(m2, cv2.COLOR_RGB2BGR))
-    matches: numpy.ndarray = cv2.matchTemplate(cv_img, cv_target, cv2.TM_CCOEFF_NORMED)
+        assert m1.shape[0] == m2.shape[0], f'must be same height: img {m1.shape}, target {m2.shape}.'
+    matches: numpy.ndarray = cv2.matchTemplate(m1, m2, cv2.TM_CCOEFF_NORMED)
     return find_peaks(matches.reshape(matches.size), height=threshold, **kwargs)[0]
 
 
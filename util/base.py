@@ -13,7 +13,7 @@ class ArgParser:
     instance = None  # type:ArgParser
     override_action = None
     override_config = None
-    valid_actions = ('battle', 'lottery', 'fp', 'server')
+    valid_actions = ('battle', 'lottery', 'fp', 'server', 'compile')
 
     def __init__(self, args: list = None):
         self._parser: Optional[argparse.ArgumentParser] = None
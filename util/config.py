@@ -1,5 +1,6 @@
 __all__ = ['Config', 'config', 'MailLevel']
 
+import atexit
 import contextlib
 import ctypes
 import json
@@ -94,7 +95,7 @@ class BattleConfig(BaseConfig):
         super().__init__()
         self.mail = MailLevel.mute
         self.battle_func = None
-        self.location = None  # default to (0,0,1920,1080)
+        self.location = None  # default to (0,0,1920,1080), or "auto" to detect from screenshot
         self.num = 1  # max battle num once running, auto decrease
         self.finished = 0  # all finished battles sum, auto increase, don't edit
         self.quartz_eaten = 0  # 突出一个心疼
@@ -123,7 +124,7 @@ class LotteryConfig(BaseConfig):
         super().__init__()
         self.mail = MailLevel.mute
         self.dir = None
-        self.location = None  # default to (0,0,1920,1080)
+        self.location = None  # default to (0,0,1920,1080), or "auto" to detect from screenshot
         self.start_func = 'draw'  # draw->clean->sell
         self.num = 10  # lottery num running once, auto decrease
         self.finished = 1  # auto increase， don't edit
@@ -138,7 +139,7 @@ class FpGachaConfig(BaseConfig):
         super().__init__()
         self.mail = MailLevel.mute
         self.dir = None
-        self.location = None
+        self.location = None  # default to (0,0,1920,1080), or "auto" to detect from screenshot
         self.num = 0
         self.finished = 0
         self.sell_times = 10
@@ -161,7 +162,23 @@ class Config(BaseConfig):
         self.lottery = LotteryConfig()
         self.fp_gacha = FpGachaConfig()
         # ================= Other part ==================
-        self.sim_algo = None
+        self.sim_algo = None  # default 'ssim', or 'ssim_fast', 'template', 'hist', 'hash'. see autogui.cal_sim
+        # max hamming distance(0~128) of image hash, targets beyond it are rejected before comparison. None: disabled
+        self.hash_prefilter = None
+        self.frame_cache_age = 0.05  # seconds, screenshots taken within it share one frame. 0 to disable cache
+        self.poll_min_interval = 0.05  # seconds, min interval of waiting loops while screen is changing
+        self.score_memo = True  # reuse the last score of template region if the compared pixels are unchanged
+        self.template_bundle = 'img/_templates.bundle'  # precompiled templates by `main.py compile`, used if exists
+        self.image_writer_queue = 8  # max images waiting to be saved in background, saving blocks if full
+        self.rewards_format = 'png'  # format of saved rewards screenshots, 'png' or 'webp'(lossless)
+        self.rewards_compress_level = None  # png: 0~9, webp: 0~6, higher is smaller but slower. None: default
+        self.rewards_crop = False  # only save the rewards grid(Regions.rewards_grid) rather than full screenshot
+        self.rewards_save = True  # save rewards screenshots, could be disabled if drops are recognized after battles
+        # folder of item templates("{item_name}.png", see DropsStat.save_item_templates) to recognize drops after
+        # every battle, e.g. "img/_drops/_items". None: disabled
+        self.drop_items_dir = None
+        self.battle_store = 'data/battles.sqlite3'  # database of every battle and its drops, see BattleStore
+        self.config_save_interval = 60  # seconds, counters like finished battles are saved at most once in it
         self.wda_settings = {'url': None}  # default url http://localhost:8100 and other options for appium_settings
         self.alert_type = False  # bool: beep, str: ring tone, alert if supervisor found errors or task finish.
         self.manual_operation_time = 60 * 10  # seconds.
@@ -193,6 +210,8 @@ class Config(BaseConfig):
         self.new_task_signal = False
 
         self.temp = {'click_xy': (0, 0)}  # save temp vars at runtime
+        self._saved_time = 0.0  # time of last save, see `save_counters`
+        self._unsaved = False  # counters changed after last save
 
         self._ignored = ['mail', 'fp', 'T', 'LOC', 'log_time', 'wda_client', 'task_finish_signal',
                          'task_thread', 'new_task_signal', 'temp']
@@ -219,8 +238,31 @@ class Config(BaseConfig):
 
     def save(self, fp=None):
         fp = fp or self.fp
+        self._saved_time = time.time()
+        self._unsaved = False
         return super().save(fp)
 
+    def save_counters(self):
+        """
+        Save after counters changed, but at most once in `config_save_interval` rather than rewriting the whole file
+        for every counter. Config is saved anyway at task finish, and every battle is recorded in `BattleStore`.
+        Deferred counters are flushed at exit too(e.g. Ctrl-C or crash), see `flush_counters`.
+        """
+        if time.time() - self._saved_time >= self.config_save_interval:
+            self.save()
+        elif not self._unsaved:
+            self._unsaved = True
+            atexit.unregister(self.flush_counters)
+            atexit.register(self.flush_counters)
+
+    def flush_counters(self):
+        """save counters not saved yet by `save_counters`"""
+        if self._unsaved and self.fp:
+            try:
+                self.save()
+            except Exception as e:  # noqa
+                print(f'failed to save config "{self.fp}": {e}', file=sys.stderr)
+
     @property
     def battle(self):
         return self.battles[self.battle_name]
@@ -276,17 +318,17 @@ class Config(BaseConfig):
     def count_lottery(self):
         self.lottery.finished += 1
         self.lottery.num -= 1
-        self.save()
+        self.save_counters()
 
     def count_fp_gacha(self):
         self.fp_gacha.finished += 1
         self.fp_gacha.num -= 1
-        self.save()
+        self.save_counters()
 
     def count_battle(self):
         self.battle.finished += 1
         self.battle.num -= 1
-        self.save()
+        self.save_counters()
 
     def record_craft_drop(self):
         self.battle.craft_num += 1
@@ -1,8 +1,13 @@
 """Data definition, constants
 Coordination: using PIL coordination, (x,y), (left,top,right,bottom), e.g. (0,0,1920-1,1080-1)
 """
+import json
 import os
+import threading
+import weakref
+from collections import OrderedDict
 
+import numpy
 from PIL import Image
 
 from .base import *
@@ -21,6 +26,11 @@ class _Regions:
     height = 1080
     box = (0, 0, width, height)
 
+    # relocated values of region items cached by (class, box, is_jp), see `relocate`
+    _layouts: Dict[Tuple, Dict[str, Any]] = {}
+    # default items of every (class, is_jp) flattened to points: (items skeleton, points array (n,2)), see `_flatten`
+    _sources: Dict[Tuple, Tuple[Dict[str, Any], numpy.ndarray]] = {}
+
     def __init__(self, is_jp=False):
         # can only relocate once
         self.__jp = is_jp
@@ -37,63 +47,113 @@ class _Regions:
                 yield k, v
 
     def reset(self, is_jp=None):
-        """Reset region values from base class _Regions"""
+        """Reset region values to default screen size"""
         if is_jp is None:
             is_jp = self.__jp
-        for k, v in _Regions._get_region_items():
-            setattr(self, k, v)
-        self.width = _Regions.width
-        self.height = _Regions.height
-        if is_jp:
-            self._override_jp()
+        self.__jp = is_jp
+        self._swap_layout(_Regions.box, _Regions.width, _Regions.height)
 
     def _override_jp(self):
         """different locations of JP, override this function"""
         pass
 
+    @classmethod
+    def _get_source(cls, is_jp: bool) -> Tuple[Dict[str, Any], numpy.ndarray]:
+        key = (cls, is_jp)
+        if key not in cls._sources:
+            items = dict(cls._get_region_items())
+            if is_jp:
+                # collect overridden items without touching any instance
+                probe = object.__new__(cls)
+                probe._override_jp()
+                items.update((k, v) for k, v in probe.__dict__.items() if isinstance(v, (list, tuple)))
+            points = []
+            skeletons = {k: cls._flatten(v, points) for k, v in items.items()}
+            cls._sources[key] = (skeletons, numpy.array(points, dtype=numpy.float64).reshape(-1, 2))
+        return cls._sources[key]
+
+    @classmethod
+    def _get_layout(cls, box: Tuple, is_jp: bool) -> Dict[str, Any]:
+        """all region items relocated into box, transformed as one numpy array and cached"""
+        key = (cls, box, is_jp)
+        layout = cls._layouts.get(key)
+        if layout is None:
+            skeletons, points = cls._get_source(is_jp)
+            old = _Regions.box
+            xs = (points[:, 0] - old[0]) / (old[2] - old[0]) * (box[2] - box[0]) + box[0]
+            ys = (points[:, 1] - old[1]) / (old[3] - old[1]) * (box[3] - box[1]) + box[1]
+            # (x,y) coordinates: in PIL it will be round then int.
+            coords = numpy.round(numpy.stack([xs, ys], 1)).astype(int).tolist()
+            layout = cls._layouts[key] = {k: cls._rebuild(v, coords) for k, v in skeletons.items()}
+        return layout
+
     @staticmethod
-    def relocate_one(region, new: Sequence, old: Sequence = (0, 0, 1919, 1079)):
-        assert isinstance(region, Sequence), f'region should be Sequence: {region}'
-        if not region:  # empty
+    def _flatten(region, points: List) -> Any:
+        """
+        Append points of region to `points`, return its skeleton:
+        a range of point indexes for point/rect, list of child skeletons for nested regions, empty region as it is.
+        """
+        if not region:
             return region
-        elif isinstance(region[0], Sequence):
-            return tuple([Regions.relocate_one(r, new, old) for r in region])
         elif isinstance(region[0], (int, float)):
             length = len(region)
             assert length % 2 == 0, f'region length must be 2(point) or 4(rect): {region}'
             if length > 4:
                 logger.warning(f'warning: more than 4 elements: {region}')
-            out = []
-            for i in range(length // 2):
-                x, y = region[i * 2:i * 2 + 2]
-                x2 = (x - old[0]) / (old[2] - old[0]) * (new[2] - new[0]) + new[0]
-                y2 = (y - old[1]) / (old[3] - old[1]) * (new[3] - new[1]) + new[1]
-                # (x,y) coordinates: in PIL it will be round then int.
-                out.append(int(round(x2)))
-                out.append(int(round(y2)))
-            return tuple(out)
+            start = len(points)
+            points.extend(zip(region[0::2], region[1::2]))
+            return range(start, len(points))
+        elif isinstance(region[0], Sequence):
+            return [_Regions._flatten(r, points) for r in region]
         else:
             raise ValueError(f'elements must be numbers: {region}')
 
+    @staticmethod
+    def _rebuild(skeleton, coords: List[List[int]]):
+        if isinstance(skeleton, range):
+            return tuple(v for i in skeleton for v in coords[i])
+        elif not skeleton:
+            return skeleton
+        return tuple(_Regions._rebuild(s, coords) for s in skeleton)
+
+    @staticmethod
+    def relocate_one(region, new: Sequence, old: Sequence = (0, 0, 1919, 1079)):
+        assert isinstance(region, Sequence), f'region should be Sequence: {region}'
+        points = []
+        skeleton = _Regions._flatten(region, points)
+        if not points:
+            return region
+        points = numpy.array(points, dtype=numpy.float64)
+        xs = (points[:, 0] - old[0]) / (old[2] - old[0]) * (new[2] - new[0]) + new[0]
+        ys = (points[:, 1] - old[1]) / (old[3] - old[1]) * (new[3] - new[1]) + new[1]
+        return _Regions._rebuild(skeleton, numpy.round(numpy.stack([xs, ys], 1)).astype(int).tolist())
+
+    def _swap_layout(self, box: Tuple, width: int, height: int):
+        # regions may be read by other threads while relocating(e.g. supervisor), build the new attributes aside
+        # and swap them in by one assignment, readers never see a half relocated layout.
+        attrs = dict(self.__dict__)
+        attrs.update(self._get_layout(box, self.__jp))
+        attrs['width'] = width
+        attrs['height'] = height
+        self.__dict__ = attrs
+
     def relocate(self, box: Sequence = None):
         """
-        Recursively resize regions of original class attributes not `self`.
+        Resize all regions of default screen size(class attributes and JP overrides) into box.
+        Relocated layouts are cached per (box, is_jp), switching box again is almost free.
 
         :param box: new region located in screenshot, (x0,y0,x1,y1): 0 <= x0 < x1 < width, 0 <= y0 < y1 < height.
-                     old box always use `self.__class__.box`
+                     old box always use `_Regions.box`
         """
-        if box is None or tuple(box) == self.box:
+        if box is None or tuple(box) == tuple(self.box):
             return
-        if tuple(self.box) != _Regions.box:
-            self.reset()
+        box = tuple(box)
         width = int(box[2] - box[0])
         height = int(box[3] - box[1])
         assert len(box) == 4 and width > 0 and height > 0, f'Invalid box: {box}'
 
-        self.width = width
-        self.height = height
-        for k, v in self._get_region_items():
-            setattr(self, k, self.relocate_one(v, box, _Regions.box))
+        # "box" itself is one of the items, it becomes the new box
+        self._swap_layout(box, width, height)
         logger.info(f'Relocate Regions from {Regions.box} to {tuple(self.box)}')
 
 
@@ -288,6 +348,7 @@ class Regions(_Regions):
     rewards_items = [[(241 + j * 206, 142 + i * 213, 401 + j * 206, 236 + i * 213) for j in range(0, 7)]
                      for i in range(0, 3)]
     rewards_item1 = (447, 142, 607, 236)  # first dropped item rect
+    rewards_grid = (233, 132, 1645, 751)  # outer box of all rewards_items_outer
     rewards_rainbow = (1452, 16, 1459, 32)
     rewards_next = (1576, 920, 1750, 1001)
 
@@ -363,6 +424,175 @@ class Regions(_Regions):
                                   (1396, 519, 1438, 542)]  # 3个lv, 强化箭头未比较, not used
 
 
+class TemplateBundle:
+    """
+    Precompiled template data of one binary file, memory-mapped. Created by `python main.py compile`.
+
+    Layout: MAGIC(8 bytes) + index length(8 bytes, little endian) + json index(padded to 16 bytes) + data.
+    Index: {"templates": {filepath: {"mtime": int, "size": int, "image_size": [w, h],
+    "regions": {"x0_y0_x1_y1": {kind: [offset, dtype, shape]}}}}}, offset is relative to the start of data.
+    Entries are only used if mtime and size of the png file are unchanged.
+    """
+    MAGIC = b'MATBDL01'
+
+    def __init__(self, fp: str):
+        self.fp = fp
+        with open(fp, 'rb') as f:
+            magic = f.read(8)
+            if magic != self.MAGIC:
+                raise ValueError(f'invalid template bundle "{fp}": magic={magic}')
+            length = int.from_bytes(f.read(8), 'little')
+            self.index: Dict[str, Dict] = json.loads(f.read(length).decode('utf8'))['templates']
+        self._data = numpy.memmap(fp, numpy.uint8, 'r', offset=16 + length)
+
+    @staticmethod
+    def key(filepath: str) -> str:
+        return os.path.relpath(filepath).replace('\\', '/')
+
+    @staticmethod
+    def region_key(region: Optional[Sequence]) -> str:
+        return 'full' if region is None else '_'.join(str(int(round(v))) for v in region)
+
+    def _entry(self, filepath: str) -> Optional[Dict]:
+        entry = self.index.get(self.key(filepath))
+        if entry is None:
+            return None
+        stat = os.stat(filepath)
+        if entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return None
+        return entry
+
+    def image_size(self, filepath: str) -> Optional[Tuple[int, int]]:
+        entry = self._entry(filepath)
+        return None if entry is None else tuple(entry['image_size'])
+
+    def get(self, filepath: str, region: Optional[Sequence], kind: str) -> Optional[numpy.ndarray]:
+        entry = self._entry(filepath)
+        item = None if entry is None else entry['regions'].get(self.region_key(region), {}).get(kind)
+        if item is None:
+            return None
+        offset, dtype, shape = item
+        dtype = numpy.dtype(dtype)
+        return self._data[offset:offset + dtype.itemsize * int(numpy.prod(shape))].view(dtype).reshape(shape)
+
+    @classmethod
+    def write(cls, fp: str, templates: Dict[str, Tuple[Tuple[int, int], Dict[str, Dict[str, numpy.ndarray]]]]):
+        """
+        :param fp: bundle filepath
+        :param templates: {png filepath: (image size, {region key: {kind: array}})}
+        """
+        index, blobs, offset = {}, [], 0
+        for filepath, (image_size, regions) in templates.items():
+            stat = os.stat(filepath)
+            entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'image_size': list(image_size), 'regions': {}}
+            for region_key, kinds in regions.items():
+                entry['regions'][region_key] = {}
+                for kind, data in kinds.items():
+                    data = numpy.ascontiguousarray(data)
+                    entry['regions'][region_key][kind] = [offset, data.dtype.str, list(data.shape)]
+                    padding = -data.nbytes % 16
+                    blobs.append(data.tobytes() + b'\0' * padding)
+                    offset += data.nbytes + padding
+            index[cls.key(filepath)] = entry
+        header = json.dumps({'templates': index}, ensure_ascii=False).encode('utf8')
+        header += b' ' * (-len(header) % 16)
+        temp_fp = fp + '.tmp'
+        os.makedirs(os.path.dirname(os.path.abspath(fp)), exist_ok=True)
+        with open(temp_fp, 'wb') as f:
+            f.write(cls.MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(temp_fp, fp)
+
+
+class LazyImage:
+    """
+    Template image file, decoded only when its pixels are needed rather than at loading.
+
+    Only the cropped regions used(see `ImageTemplates.region_data`) are kept in memory, and they are saved in
+    "_cache" folder beside the image as .npy files, which are memory-mapped on later runs.
+    Other attributes of PIL image are supported by decoding the full image, e.g. `save`, `getpixel`.
+    """
+    # recently decoded full images shared by all lazy images, to crop several regions without decoding again
+    _decoded: 'OrderedDict[str, Image.Image]' = OrderedDict()
+    _decoded_max = 4
+    _lock = threading.Lock()
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._size: Optional[Tuple[int, int]] = None
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        if self._size is None and ImageTemplates.bundle is not None:
+            self._size = ImageTemplates.bundle.image_size(self.filepath)
+        if self._size is None:
+            # only the header is read
+            with Image.open(self.filepath) as image:
+                self._size = image.size
+        return self._size
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def load(self) -> Image.Image:
+        """decoded full image, only a few recently used ones are kept"""
+        with self._lock:
+            image = self._decoded.pop(self.filepath, None)
+            if image is None:
+                image = Image.open(self.filepath)
+                image.load()
+            self._decoded[self.filepath] = image
+            while len(self._decoded) > self._decoded_max:
+                self._decoded.popitem(last=False)
+            return image
+
+    def crop(self, box: Sequence = None) -> Image.Image:
+        """RGB image cropped at box, which is cached, see `region_array`"""
+        if box is None:
+            return self.load().copy()
+        return Image.fromarray(ImageTemplates.region_data(self, box, 'rgb'))
+
+    def region_array(self, region: Optional[Tuple]) -> numpy.ndarray:
+        """RGB array cropped at region, read from the on-disk cache or decoded and saved to cache"""
+        folder, filename = os.path.split(self.filepath)
+        stat = os.stat(self.filepath)
+        stem = f'{filename[:-4]}-{stat.st_mtime_ns:x}-{stat.st_size:x}'
+        suffix = 'full' if region is None else '_'.join(str(v) for v in region)
+        cache_fp = os.path.join(folder, '_cache', f'{stem}-{suffix}.npy')
+        if os.path.exists(cache_fp):
+            try:
+                return numpy.load(cache_fp, mmap_mode='r')
+            except (OSError, ValueError) as e:
+                logger.warning(f'invalid template cache "{cache_fp}", rebuild it: {e}')
+        image = self.load()
+        cropped = image if region is None else image.crop(region)
+        data = numpy.array(cropped.convert('RGB') if cropped.mode != 'RGB' else cropped)
+        try:
+            os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+            numpy.save(cache_fp, data)
+        except OSError as e:
+            logger.warning(f'failed to save template cache "{cache_fp}": {e}')
+        return data
+
+    def __getattr__(self, item):
+        # other attributes of PIL image. Not for special attributes or a half constructed instance,
+        # e.g. copy/pickle look up `__reduce_ex__`, `__setstate__`... before `__init__`
+        if item.startswith('__') or 'filepath' not in self.__dict__:
+            raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{item}'")
+        return getattr(self.load(), item)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}("{self.filepath}")'
+
+
 class ImageTemplates:
     """
     Store loaded template images. Image file(*.png) should be screenshots token by PIL or mss module.
@@ -372,7 +602,7 @@ class ImageTemplates:
 
     def __init__(self, directory: str = None, recursive=False):
         self.dirs: str = directory
-        self.templates: Dict[str, Image.Image] = {}
+        self.templates: Dict[str, LazyImage] = {}
 
         # ============ error part ============
         self.net_error = None
@@ -458,6 +688,101 @@ class ImageTemplates:
         if directory is not None:
             self.read_templates(directory, recursive=recursive)
 
+    # data derived from template images, shared by all instances: {id(image): {(region, kind): data}}.
+    # Entries are dropped once the image is garbage collected, see `region_data`.
+    _derived: Dict[int, Dict[Tuple, Any]] = {}
+    # functions to derive data from the cropped 'rgb' array: {kind: func(rgb) -> data}
+    _region_kinds: Dict[str, Callable[[numpy.ndarray], Any]] = {}
+    # precompiled data of lazy images, see `load_bundle`
+    bundle: Optional[TemplateBundle] = None
+
+    @classmethod
+    def register_region_kind(cls, kind: str, func: Callable[[numpy.ndarray], Any]):
+        """Register how to derive data of `kind` from the cropped RGB array, see `region_data`."""
+        cls._region_kinds[kind] = func
+
+    @classmethod
+    def region_data(cls, image: Union[Image.Image, numpy.ndarray], region: Sequence = None, kind: str = 'rgb',
+                    size: Tuple[int, int] = None):
+        """
+        Cached data derived from `image` cropped at `region`, computed at the first access.
+        Arrays are contiguous and read-only, channels are in RGB order as PIL.
+
+        :param image: template image, PIL image, `LazyImage` or RGB array
+        :param region: region to crop in PIL coordination, None for the whole image.
+        :param kind: 'rgb': uint8 array (h,w,3), or other kinds registered by `register_region_kind`,
+                     see `util.autogui` for 'gray', 'template', 'hist'...
+        :param size: (width, height), resize the cropped image to it before deriving if not None,
+                     e.g. templates of default layout compared at relocated regions, see `autogui.template_data`.
+        """
+        region = None if region is None else tuple(int(round(v)) for v in region)
+        if size is not None:
+            size = (int(size[0]), int(size[1]))
+            rgb = cls.region_data(image, region, 'rgb')
+            if (rgb.shape[1], rgb.shape[0]) == size:
+                return cls.region_data(image, region, kind)
+        key = (region, kind) if size is None else (region, kind, size)
+        image_id = id(image)
+        cache = cls._derived.get(image_id)
+        if cache is None:
+            cache = cls._derived[image_id] = {}
+            weakref.finalize(image, cls._derived.pop, image_id, None)
+        data = cache.get(key)
+        if data is None:
+            if size is None:
+                data = cls._compute_region_data(image, region, kind)
+            elif kind == 'rgb':
+                data = numpy.array(Image.fromarray(cls.region_data(image, region, 'rgb')).resize(size, Image.BICUBIC))
+                data.setflags(write=False)
+            else:
+                data = cls.derive_region_data(cls.region_data(image, region, 'rgb', size), kind)
+            cache[key] = data
+        return data
+
+    @classmethod
+    def load_bundle(cls, fp: Optional[str]):
+        """use precompiled template bundle if `fp` exists, see `TemplateBundle`. None to unload"""
+        if fp is None or not os.path.exists(fp):
+            cls.bundle = None
+            return
+        try:
+            cls.bundle = TemplateBundle(fp)
+            logger.info(f'loaded template bundle "{fp}": {len(cls.bundle.index)} templates')
+        except (OSError, ValueError) as e:
+            cls.bundle = None
+            logger.warning(f'failed to load template bundle "{fp}": {e}')
+
+    @classmethod
+    def derive_region_data(cls, rgb: numpy.ndarray, kind: str):
+        """derive data of `kind` from the cropped rgb array, see `register_region_kind`"""
+        if kind == 'rgb':
+            return rgb
+        if kind not in cls._region_kinds:
+            raise KeyError(f'invalid kind of region data: "{kind}"')
+        return cls._region_kinds[kind](rgb)
+
+    @classmethod
+    def _compute_region_data(cls, image: Union[Image.Image, numpy.ndarray], region: Optional[Tuple], kind: str):
+        if isinstance(image, LazyImage) and cls.bundle is not None:
+            data = cls.bundle.get(image.filepath, region, kind)
+            if data is not None:
+                return data
+        if kind == 'rgb':
+            if isinstance(image, LazyImage):
+                data = image.region_array(region)
+            elif isinstance(image, numpy.ndarray):
+                if region is not None:
+                    image = image[max(0, region[1]):max(0, region[3]), max(0, region[0]):max(0, region[2])]
+                data = numpy.array(image[:, :, :3])
+            else:
+                cropped = image if region is None else image.crop(region)
+                data = numpy.array(cropped.convert('RGB') if cropped.mode != 'RGB' else cropped)
+        else:
+            data = cls.derive_region_data(cls.region_data(image, region, 'rgb'), kind)
+        if isinstance(data, numpy.ndarray):
+            data.setflags(write=False)
+        return data
+
     def read_templates(self, directory: Union[str, List[str]] = None, append=False, recursive=False):
         """
         Read template .png images from one or more dirs. If duplicated filenames, the last image will be remained
@@ -495,9 +820,11 @@ class ImageTemplates:
                 continue
             # filepath = os.path.join(directory, filepath)
             key = os.path.basename(filepath)[:-4]
-            if self.__dict__.get(key, None) is not None and not isinstance(self.__dict__[key], Image.Image):
+            if self.__dict__.get(key, None) is not None \
+                    and not isinstance(self.__dict__[key], (Image.Image, LazyImage)):
                 raise ValueError(f'Key "{key}" already exist (not image): {self.__dict__[key]}')
-            self.__dict__[key] = self.templates[key] = Image.open(filepath)
+            # decoded at the first access, only regions used are kept
+            self.__dict__[key] = self.templates[key] = LazyImage(filepath)
         self.dirs.append(directory)
 
     def __repr__(self):
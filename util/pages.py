@@ -0,0 +1,211 @@
+"""Declarative page registry and classifier to find out which page the game is on"""
+import fnmatch
+
+from .autogui import *
+from .config import *
+
+
+class Page:
+    """
+    A page(screen state) which is recognized when its template matches at all regions.
+
+    Template and regions are declared by attribute names of `ImageTemplates` and `Regions` and resolved at
+    classification time, so that reloaded templates and relocated regions are always used.
+    """
+
+    def __init__(self, name: str, template: str, regions, threshold: float = None):
+        """
+        :param name: page id.
+        :param template: attribute name in `ImageTemplates`.
+        :param regions: attribute name in `Regions`(its value could be a list of regions), a literal region,
+                        or a list of them.
+        :param threshold: default `THR`.
+        """
+        self.name = name
+        self.template = template
+        self.regions = regions
+        self.threshold = threshold
+
+    def resolve(self, T: ImageTemplates, LOC: Regions):
+        # type:(ImageTemplates,Regions)->Tuple[Optional[Image.Image],List[Sequence]]
+        """:return: template image(None if not loaded) and the list of regions"""
+        template = getattr(T, self.template, None)
+        regions = getattr(LOC, self.regions) if isinstance(self.regions, str) else self.regions
+        if isinstance(regions[0], (int, float)):
+            regions = [regions]
+        regions = [getattr(LOC, r) if isinstance(r, str) else r for r in regions]
+        return template, regions
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}, template={self.template}, regions={self.regions})'
+
+
+class PageMatch:
+    """Result of `classify_page`. `name` is None if no page matched."""
+
+    def __init__(self, name: Optional[str], confidence: float, confidences: Dict[str, float]):
+        self.name = name
+        # confidence of page is the min score over its regions
+        self.confidence = confidence
+        self.confidences = confidences
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}, confidence={self.confidence:.4f})'
+
+
+PAGES: Dict[str, Page] = {}
+# {template name or pattern: regions}, see `register_template_regions`
+TEMPLATE_REGIONS: Dict[str, List] = {}
+
+
+def register_page(name: str, template: str, regions, threshold: float = None) -> Page:
+    """register or override a page, see `Page`"""
+    page = PAGES[name] = Page(name, template, regions, threshold)
+    return page
+
+
+def register_template_regions(template: str, *regions):
+    """
+    Declare regions where the template is compared besides registered pages, which are precompiled into
+    the template bundle, see `TemplateCompiler`.
+
+    :param template: attribute name in `ImageTemplates`, or a pattern like "wave*" for a family of templates.
+    :param regions: attribute names in `Regions`(their values could be lists of regions) or literal regions.
+    """
+    TEMPLATE_REGIONS.setdefault(template, []).extend(regions)
+
+
+def template_regions(name: str, LOC: Regions) -> List[Sequence]:
+    """all regions of template `name` in registered pages and `TEMPLATE_REGIONS`"""
+    regions = []
+    T = ImageTemplates()
+    for page in PAGES.values():
+        if page.template == name:
+            regions.extend(page.resolve(T, LOC)[1])
+    for pattern, items in TEMPLATE_REGIONS.items():
+        if fnmatch.fnmatchcase(name, pattern):
+            for item in items:
+                regions.extend(_flatten_regions(getattr(LOC, item, None) if isinstance(item, str) else item))
+    return regions
+
+
+def _flatten_regions(value) -> List[Sequence]:
+    """rects(length 4) of possibly nested regions, points are ignored"""
+    if not value:
+        return []
+    if isinstance(value[0], (int, float)):
+        return [value] if len(value) == 4 else []
+    return [r for v in value for r in _flatten_regions(v)]
+
+
+def classify_page(img: ImageLike = None, names: Sequence[str] = None, T=None, LOC=None, threshold=None):
+    # type:(ImageLike,Sequence[str],ImageTemplates,Regions,float)->PageMatch
+    """
+    Score the frame against all candidate pages in one batched pass(see `match_scores`),
+    the first page in `names` whose confidence passes its threshold is returned.
+
+    :param img: frame, default take a new screenshot.
+    :param names: candidate page names or `Page` objects in priority order, default all registered pages.
+    :param T: default `config.T`
+    :param LOC: default `config.LOC`
+    :param threshold: override the thresholds of pages.
+    """
+    if img is None:
+        img = screenshot(as_array=True)
+    T = T or config.T
+    LOC = LOC or config.LOC
+    names = list(PAGES.keys()) if names is None else names
+    targets, regions, spans = [], [], {}
+    pages = {}
+    for name in names:
+        page = name if isinstance(name, Page) else PAGES[name]
+        template, page_regions = page.resolve(T, LOC)
+        if template is None:
+            continue
+        pages[page.name] = page
+        spans[page.name] = (len(targets), len(targets) + len(page_regions))
+        targets.extend([template] * len(page_regions))
+        regions.extend(page_regions)
+    scores = match_scores(img, targets, regions, parallel=True).scores if targets else []
+    confidences = {name: float(numpy.min(scores[start:end])) for name, (start, end) in spans.items()}
+    for name, confidence in confidences.items():
+        page_thr = threshold or pages[name].threshold or THR
+        if confidence >= page_thr:
+            return PageMatch(name, confidence, confidences)
+    return PageMatch(None, max(confidences.values(), default=-numpy.inf), confidences)
+
+
+def wait_page(names: Sequence[str], T=None, LOC=None, threshold=None, clicking=None, interval=0.2) -> str:
+    """
+    Waiting for screenshot to match one of pages, see `classify_page` and `wait_which_target`.
+
+    :param clicking: a region to click at until some page matches.
+    :return: the matched page name.
+    """
+    poller = FramePoller(max_interval=interval, refresh=interval if clicking is not None else 2.0)
+    while True:
+        name = classify_page(poller.next(), names, T, LOC, threshold).name
+        if name is not None:
+            return name
+        if clicking is not None:
+            for _ in range(3):
+                click(clicking, 0)
+
+
+# %% pages shared by battle, lottery and fp gacha, key is usually the template name
+register_page('net_error', 'net_error', 'net_error')
+register_page('svt_status_window', 'svt_status_window', 'svt_status_window_close')
+register_page('login_news', 'login_news', 'login_news_close')
+register_page('login_terminal', 'login_terminal', 'login_terminal_event_banner')
+register_page('login_popup', 'login_popup', 'menu_button')
+register_page('quest', 'quest', 'quest')
+register_page('quest_menu', 'quest', 'menu_button')
+register_page('support', 'support', 'support_refresh')
+register_page('apple_page', 'apple_page', 'apple_close')
+register_page('bag_full_alert', 'bag_full_alert', 'bag_full_sell_button')
+register_page('restart_quest', 'restart_quest', 'restart_quest_yes')
+register_page('apply_friend', 'apply_friend', 'apply_friend')
+register_page('gacha_quartz_page', 'gacha_quartz_page', 'gacha_quartz_logo')
+register_page('gacha_fp_page', 'gacha_fp_page', 'gacha_fp_logo')
+register_page('gacha_fp_confirm', 'gacha_fp_confirm', 'gacha_fp_confirm', 0.7)
+register_page('gacha_fp_result', 'gacha_fp_result', 'gacha_fp_result_summon', 0.7)
+register_page('gacha_fp_ce_full', 'gacha_fp_ce_full', 'bag_full_sell_button', 0.7)
+
+# regions where templates are compared outside of pages, precompiled by `TemplateCompiler`
+register_template_regions('wave*', 'attack', 'loc_wave', 'master_skill', 'skills', 'master_skills', 'enemies')
+register_template_regions('cards*', 'cards_back')
+register_template_regions('support*', 'support_refresh', 'support_class_affinity', 'support_team_icon',
+                          'support_skill', 'support_skills', 'support_ce', 'support_ce_max', 'support_friend_icon')
+register_template_regions('support_confirm', 'support_confirm_title')
+register_template_regions('apple_page', 'apples')
+register_template_regions('apple_confirm', 'apple_confirm')
+register_template_regions('team', 'team_cloth_button')
+register_template_regions('skill_targets', 'skill_targets_close')
+register_template_regions('order_change', 'order_change_close')
+register_template_regions('rewards', 'rewards_item1', 'rewards_rainbow', 'rewards_suochi_character')
+register_template_regions('rewards_init', 'rewards_show_num')
+register_template_regions('craft_detail', 'craft_detail_tab1')
+register_template_regions('shop', 'menu_button', 'shop_event_item_exchange')
+register_template_regions('shop_event_banner_list', 'shop_event_banner_list')
+register_template_regions('login_page', 'menu_button')
+register_template_regions('login1', (1000, 480, 1350, 600))
+register_template_regions('menu', 'menu_gacha_button')
+register_template_regions('bag_selected', 'bag_sell_action')
+register_template_regions('bag_unselected', 'bag_svt_tab', 'bag_sell_action')
+register_template_regions('bag_qp_limit', 'bag_qp_limit_confirm')
+register_template_regions('bag_sell_finish', 'bag_sell_confirm', 'bag_sell_finish')
+register_template_regions('lottery_initial', 'lottery_tab', 'lottery_10_initial')
+register_template_regions('lottery_empty', 'lottery_empty', 'lottery_reset_action')
+register_template_regions('mailbox_full_alert', 'mailbox_full_confirm')
+register_template_regions('mailbox_unselected*', 'mailbox_get_all_action', 'mailbox_back', 'mailbox_first_checkbox',
+                          'mailbox_first_xn', 'mailbox_first_icon', 'mailbox_first_xn2')
+register_template_regions('gacha_quartz_page', 'gacha_help')
+register_template_regions('gacha_fp_page', 'gacha_fp_logo', 'gacha_fp_10_button')
+register_template_regions('gacha_fp_result', 'gacha_fp_logo')
+register_template_regions('gacha_fp_svt_full', 'fp_bag_full_title')
+register_template_regions('gacha_fp_ce_full', 'fp_bag_full_title')
+register_template_regions('ce_enhance_empty', 'ce_enhance_help', 'ce_target_box', 'ce_enhance_lv2')
+register_template_regions('ce_enhance_page', 'ce_target_box', 'ce_enhance_lv2')
+register_template_regions('ce_select_target', 'ce_select_mode', 'ce_targets')
+register_template_regions('ce_items_unselected', 'ce_select_button')
+register_template_regions('ce_items_selected', 'ce_select_button')
@@ -2,6 +2,7 @@ from .addon import *
 from .autogui import *
 from .config import *
 from .log import *
+from .pages import *
 
 
 def supervise_log_time(thread, timeout=60, interval=10, alert_type=None, alert_loops=15):
@@ -46,25 +47,27 @@ def supervise_log_time(thread, timeout=60, interval=10, alert_type=None, alert_l
         else:
             T: ImageTemplates = config.T
             LOC: Regions = config.LOC
+            # emulator window may be moved or resized
+            if config.temp.get('auto_locate') and LOC is not None and auto_relocate(LOC):
+                logger.warning(f'screen box changed, relocated to {LOC.box}')
+                config.update_time()
+                continue
+            page = classify_page(screenshot(as_array=True), ['net_error', 'svt_status_window'], T, LOC).name
             # case 4: task alive and network error - click "retry" and continue
-            img_net, loc_net = T.net_error, LOC.net_error
-            if img_net is not None and loc_net is not None:
-                shot = screenshot()
-                if match_targets(shot, img_net, loc_net[0]) and match_targets(shot, img_net, loc_net[1]):
-                    logger.warning('Network error! click "retry" button')
-                    click(loc_net[1], lapse=3)
-                    config.update_time(60)
-                    continue
+            if page == 'net_error':
+                logger.warning('Network error! click "retry" button')
+                click(LOC.net_error[1], lapse=3)
+                config.update_time(60)
+                continue
 
             # case 5: svt status window is popped unexpectedly when execute svt skill(actually not executed yet)
-            if T.svt_status_window is not None:
-                if match_targets(screenshot(), T.svt_status_window, LOC.svt_status_window_close):
-                    screenshot().save(f'img/crash/svt_status_window_error_{time.time()}.png')
-                    xy = config.temp.get('click_xy', (0, 0))  # skill location last clicked
-                    logger.warning(f'Servant status window is popped unexpectedly! Re-click at {xy}')
-                    click(LOC.svt_status_window_close, 2)
-                    click(xy)
-                    config.update_time(30)
+            if page == 'svt_status_window':
+                screenshot().save(f'img/crash/svt_status_window_error_{time.time()}.png')
+                xy = config.temp.get('click_xy', (0, 0))  # skill location last clicked
+                logger.warning(f'Servant status window is popped unexpectedly! Re-click at {xy}')
+                click(LOC.svt_status_window_close, 2)
+                click(xy)
+                config.update_time(30)
 
             # case 6: task alive and need re-login after 3am in jp server
             # if match menu button, click save_area until match quest1234, click 1234
@@ -103,13 +106,17 @@ def supervise_log_time(thread, timeout=60, interval=10, alert_type=None, alert_l
 
 def start_loop(func: Callable):
     config.new_task_signal = True
-    while True:
-        if not config.new_task_signal:
-            time.sleep(5)
-        else:
-            config.new_task_signal = False
-            func()
-            logger.info('waiting new task...')
-            if config.www_host_port is not None:
-                host, port = (config.www_host_port + [None, None])[:2]
-                logger.info(f'Server is running on http://{host or "0.0.0.0"}:{port or 8180}')
+    try:
+        while True:
+            if not config.new_task_signal:
+                time.sleep(5)
+            else:
+                config.new_task_signal = False
+                func()
+                logger.info('waiting new task...')
+                if config.www_host_port is not None:
+                    host, port = (config.www_host_port + [None, None])[:2]
+                    logger.info(f'Server is running on http://{host or "0.0.0.0"}:{port or 8180}')
+    finally:
+        # Ctrl-C in interactive mode doesn't exit the interpreter, flush counters deferred by `save_counters`
+        config.flush_counters()
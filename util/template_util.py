@@ -26,7 +26,7 @@ def capture(fn: str = None, _base: str = None):
         print(f'make dir: {_base}')
     time.sleep(0.1)
     t0 = time.time()
-    img = screenshot()
+    img = screenshot(fresh=True)
     if fn and _base is not None:
         full_fp = os.path.join(_base or base_path, fn + '.png')
         if os.path.exists(full_fp):
@@ -41,7 +41,7 @@ def capture(fn: str = None, _base: str = None):
 
 def save_rewards(quest_name: str = None, cfg=None, count=True, drop: int = None):
     config.load(cfg)
-    img = screenshot()
+    img = screenshot(fresh=True)
     if quest_name:
         if count:
             config.count_battle()